@@ -53,6 +53,7 @@ import numpy as np
 import pandas as pd
 import multiprocessing as mp
 import shutil
+import zipfile
 from glob import glob
 from scipy.ndimage.morphology import binary_erosion
 
@@ -135,6 +136,7 @@ def main():
     # Similarity metrics output files
     inter_metrics_csv = os.path.join(atlas_dir, 'inter_observer_metrics.csv')
     intra_metrics_csv = os.path.join(atlas_dir, 'intra_observer_metrics.csv')
+    metrics_npz = os.path.join(atlas_dir, 'similarity_metrics.npz')
 
     # Loop over observer directories ("obs-*")
     # Load labeled images and collect into a nested list
@@ -241,7 +243,10 @@ def main():
         # Inter-observer metrics
         inter_metrics_all.append(inter_observer_metrics(label_mask, vox_mm))
 
-    # Write metrics to report directory as CSV
+    # Write metrics to atlas directory as a columnar store for atlas_report.py
+    save_metrics(metrics_npz, intra_metrics_all, inter_metrics_all, label_nos, label_key)
+
+    # Export metrics to atlas directory as CSV
     save_intra_metrics(intra_metrics_csv, intra_metrics_all, label_nos, label_key)
     save_inter_metrics(inter_metrics_csv, inter_metrics_all, label_nos, label_key)
 
@@ -528,6 +533,100 @@ def save_inter_metrics(fname, inter_metrics, label_nos, label_key):
                         writer.writerow((label_name, label_no, tmp, obsA, obsB) + m_ob)
 
 
+def save_metrics(fname, intra_metrics, inter_metrics, label_nos, label_key):
+    """
+    Save intra and inter-observer metrics as typed arrays in an uncompressed NPZ
+    - intra-observer arrays are shaped [label][observer][tmpA][tmpB]
+    - inter-observer arrays are shaped [label][template][obsA][obsB]
+    - uncompressed members can be memory-mapped by load_metrics_store
+
+    Parameters
+    ----------
+    fname: NPZ filename
+    intra_metrics: nlabels x nobs x ntmp x ntmp nested list of metric tuples
+    inter_metrics: nlabels x ntmp x nobs x nobs nested list of metric tuples
+    label_nos: list of label numbers
+    label_key: data frame
+
+    Returns
+    -------
+
+    """
+
+    print('Saving similarity metrics to %s' % fname)
+
+    # Last axis holds (dice, hausdorff, nA, nB)
+    intra = np.array(intra_metrics, dtype=np.float64)
+    inter = np.array(inter_metrics, dtype=np.float64)
+
+    n_labels, n_obs, n_tmp = intra.shape[:3]
+
+    label_names = np.array([get_label_name(label_no, label_key) for label_no in label_nos], dtype=str)
+
+    np.savez(fname,
+             label_names=label_names,
+             label_nos=np.array(label_nos, dtype=np.int32),
+             observers=np.arange(n_obs, dtype=np.int32),
+             templates=np.arange(n_tmp, dtype=np.int32),
+             intra_dice=intra[..., 0].astype(np.float32),
+             intra_haus=intra[..., 1].astype(np.float32),
+             intra_nA=intra[..., 2].astype(np.uint32),
+             intra_nB=intra[..., 3].astype(np.uint32),
+             inter_dice=inter[..., 0].astype(np.float32),
+             inter_haus=inter[..., 1].astype(np.float32),
+             inter_nA=inter[..., 2].astype(np.uint32),
+             inter_nB=inter[..., 3].astype(np.uint32))
+
+
+def load_metrics_store(fname):
+    """
+    Load metrics store written by save_metrics, memory-mapping each array
+    in place within the uncompressed NPZ rather than reading it into memory
+
+    Parameters
+    ----------
+    fname: NPZ filename
+
+    Returns
+    -------
+    store: dictionary of read-only numpy arrays keyed by array name
+    """
+
+    store = {}
+
+    with zipfile.ZipFile(fname) as zf, open(fname, 'rb') as f:
+
+        for info in zf.infolist():
+
+            key = os.path.splitext(info.filename)[0]
+
+            if info.compress_type != zipfile.ZIP_STORED:
+                # Compressed member - fall back to reading into memory
+                with zf.open(info) as member:
+                    store[key] = np.lib.format.read_array(member)
+                continue
+
+            # Skip local file header to start of NPY data
+            f.seek(info.header_offset + 26)
+            n_name, n_extra = np.frombuffer(f.read(4), dtype='<u2')
+            f.seek(n_name + n_extra, 1)
+
+            # Parse NPY header
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+
+            if np.prod(shape) == 0:
+                store[key] = np.zeros(shape, dtype=dtype)
+            else:
+                store[key] = np.memmap(fname, dtype=dtype, mode='r', shape=shape,
+                                       order='F' if fortran_order else 'C', offset=f.tell())
+
+    return store
+
+
 def similarity(mask_a, mask_b, vox_mm):
     """
 
@@ -3,14 +3,19 @@
 Analyse mutual volume overlap of lesion labels with probabilistic atlas labels
 - Outputs relative and absolute volume overlaps
 - Overlap volumes relative to both lesion and atlas labels
+- Cohort mode: several lesion images (or glob patterns) share one atlas load and
+  are tabulated in a single long-format CSV
 
 Usage
 ----
 atlas_lesion_analysis.py
-    -l <3D lesion label image>
+    -l <3D lesion label image> [<3D lesion label image> ...]
     -a <4D prob atlas image>
     [-lk <lesion label key>]
     [-ak <atlas label key>]
+    [-o <cohort output directory>]
+    [-j <number of worker processes>]
+    [--nohtml]
 
 Authors
 ----
@@ -45,27 +50,45 @@ Copyright
 
 import os
 import sys
+import glob
 import argparse
+import multiprocessing as mp
 import nibabel as nib
 import numpy as np
+from scipy import sparse
 
 __version__ = '0.1.0'
 
+# Shared atlas state for lesion intersection workers (set once per process)
+_atlas = None
+_hemi_xx = None
+_l_indices = None
+
 
 def main():
 
     # Construct a command line argument parser
     parser = argparse.ArgumentParser(description='Atlas-based lesion volumetrics')
-    parser.add_argument('-l', '--lesion', required=True, help='3D lesion labels')
+    parser.add_argument('-l', '--lesion', required=True, nargs='+',
+                        help='3D lesion labels (one or more images or glob patterns)')
     parser.add_argument('-a', '--atlas', required=True, help='4D bilateral probabilistic atlas labels')
     parser.add_argument('-lk', '--lesionkey', required=False, help='Lesion label key (ITKSNAP format)')
     parser.add_argument('-ak', '--atlaskey', required=False, help='Atlas label key (ITKSNAP format)')
+    parser.add_argument('-o', '--outdir', required=False, default='.',
+                        help='Output directory for cohort CSV [.]')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of lesion worker processes [1]')
+    parser.add_argument('--nohtml', action='store_true', default=False,
+                        help='Skip bokeh HTML report (CSV only)')
 
     # Parse command line arguments
     args = parser.parse_args()
-    lesion_fname = args.lesion
     atlas_fname = args.atlas
 
+    # Expand lesion glob patterns, keeping literal filenames without matches
+    lesion_fnames = []
+    for pattern in args.lesion:
+        lesion_fnames.extend(sorted(glob.glob(pattern)) or [pattern])
+
     if args.lesionkey:
         lesion_keyfname = args.lesionkey
     else:
@@ -76,28 +99,13 @@ def main():
     else:
         atlas_keyfname = []
 
-    # Load lesion label image
-    try:
-        print('  Loading lesion labels from %s' % lesion_fname)
-        lesion_nii = nib.load(lesion_fname)
-        lesion = lesion_nii.get_data()
-
-    except:
-        print('* Problem loading lesion image')
-
-    # Load probabilistic atlas
+    # Load probabilistic atlas once (memory mapped for uncompressed images)
     try:
         print('  Loading probabilistic atlas from %s' % atlas_fname)
         atlas_nii = nib.load(atlas_fname)
-        atlas = atlas_nii.get_data()
+        atlas = np.asanyarray(atlas_nii.dataobj)
     except:
         print('* Problem loading atlas image')
-
-    # Check that atlas and lesion 3D dimensions match
-    lesion_dims = lesion.shape
-    atlas_dims = (atlas.shape)[0:3]
-    if not np.array_equal(lesion_dims, atlas_dims):
-        print('* Lesion and atlas image dimensions do not match - exiting')
         sys.exit(1)
 
     # Load ITK-SNAP label key lists
@@ -114,7 +122,102 @@ def main():
 
     # Split probalistic atlas into left and right hemisphere labels
     # Update atlas label key accordingly
-    atlas_split, atlas_key_split = split_brain(atlas, atlas_key)
+    hemi_xx, atlas_key_split = split_brain(atlas, atlas_key)
+
+    # Split atlas label volumes (in voxels) are common to all lesion images
+    a_vox = atlas_volumes(atlas, hemi_xx)
+
+    # Lesion and intersection volumes for each lesion image
+    l_indices = [l_label[0] for l_label in lesion_key]
+    init_worker(atlas, hemi_xx, l_indices)
+
+    if args.jobs > 1 and len(lesion_fnames) > 1:
+        with mp.Pool(args.jobs, initializer=init_worker, initargs=(atlas, hemi_xx, l_indices)) as pool:
+            tables = pool.map(lesion_intersections, lesion_fnames)
+    else:
+        tables = list(map(lesion_intersections, lesion_fnames))
+
+    # Single lesion image - per-lesion report alongside the lesion image
+    if len(lesion_fnames) == 1:
+
+        lesion_fname, l_vox, i_vox = tables[0]
+        if l_vox is None:
+            sys.exit(1)
+
+        results = tabulate_results(lesion_key, atlas_key_split, l_vox, a_vox, i_vox, vox_ul)
+
+        # Create HTML and CSV reports
+        out_dir = os.path.dirname(os.path.abspath(lesion_fname))
+        report_results(results, out_dir, html=not args.nohtml)
+
+    else:
+
+        # Cohort - one long-format CSV over all subjects
+        cohort_results = []
+        for lesion_fname, l_vox, i_vox in tables:
+            if l_vox is not None:
+                results = tabulate_results(lesion_key, atlas_key_split, l_vox, a_vox, i_vox, vox_ul,
+                                           verbose=False)
+                cohort_results.append((subject_name(lesion_fname), results))
+
+        report_cohort(cohort_results, args.outdir)
+
+    # Clean exit
+    sys.exit(0)
+
+
+def init_worker(atlas, hemi_xx, l_indices):
+    """
+    Share the atlas, hemisphere split and lesion label indices with lesion workers
+    """
+
+    global _atlas, _hemi_xx, _l_indices
+
+    _atlas, _hemi_xx, _l_indices = atlas, hemi_xx, l_indices
+
+
+def lesion_intersections(lesion_fname):
+    """
+    Lesion label and intersection volumes for one lesion image against the shared atlas
+
+    Parameters
+    ----------
+    lesion_fname: 3D lesion label image filename
+
+    Returns
+    -------
+    lesion_fname: string
+    l_vox: numpy array [n_lesion] or None on failure
+    i_vox: numpy array [n_lesion x 2 n_atlas] or None on failure
+    """
+
+    # Load lesion label image
+    try:
+        print('  Loading lesion labels from %s' % lesion_fname)
+        lesion = np.asanyarray(nib.load(lesion_fname).dataobj)
+    except:
+        print('* Problem loading lesion image %s' % lesion_fname)
+        return lesion_fname, None, None
+
+    # Check that atlas and lesion 3D dimensions match
+    if not np.array_equal(lesion.shape, _atlas.shape[0:3]):
+        print('* Lesion and atlas image dimensions do not match for %s' % lesion_fname)
+        return lesion_fname, None, None
+
+    l_vox, i_vox = intersection_table(lesion, _atlas, _l_indices, _hemi_xx)
+
+    return lesion_fname, l_vox, i_vox
+
+
+def tabulate_results(lesion_key, atlas_key_split, l_vox, a_vox, i_vox, vox_ul, verbose=True):
+    """
+    Nested results lists of absolute and relative intersection volumes for one lesion image
+
+    Returns
+    -------
+    results: list of lesion results lists
+        rows [l_name, a_name, l_vol_ul, a_vol_ul, intersect_vol_ul, l_perc, a_perc]
+    """
 
     # Init result list
     results = []
@@ -122,15 +225,13 @@ def main():
     # Iterate over lesion labels
     for l_c, l_label in enumerate(lesion_key):
 
-        l_index, l_name = l_label[0], l_label[7]
-
-        # Extract binary mask for current lesion label
-        l_mask = lesion == l_index
+        l_name = l_label[7]
 
         # Current lesion label volume in ul
-        l_vol_ul = l_mask.sum() * vox_ul
+        l_vol_ul = l_vox[l_c] * vox_ul
 
-        print('Processing %s' % l_name)
+        if verbose:
+            print('Processing %s' % l_name)
 
         # Lesion results and column header
         lesion_results = []
@@ -140,44 +241,179 @@ def main():
 
             a_i, a_name = a_label[0], a_label[7]
 
-            print('  Atlas label %s (%d)' % (a_name, a_i))
-
-            # Extract probability field for current atlas label
-            a_prob = atlas_split[:,:,:,a_c]
-
             # Integrated volume of prob atlas label
-            a_vol_ul = a_prob.sum() * vox_ul
-            print('    Atlas label volume : %0.1f ul' % a_vol_ul)
-
-            # Voxel-wise multiply lesion label and atlas prob image
-            intersect = l_mask * a_prob
+            a_vol_ul = a_vox[a_c] * vox_ul
 
             # Lesion-atlas intersection volume in ul
-            intersect_vol_ul = intersect.sum() * vox_ul
-            print('    Lesion-atlas label intersection volume : %0.1f ul' % intersect_vol_ul)
+            intersect_vol_ul = i_vox[l_c, a_c] * vox_ul
 
             # Intersection as a percentage of lesion volume
             l_perc = intersect_vol_ul / l_vol_ul * 100.0
-            print('    Intersection as a fraction of lesion voume : %0.1f%%' % l_perc)
 
             # Lesion-masked atlas volume normalized to atlas label volume
             a_perc = intersect_vol_ul / a_vol_ul * 100.0
-            print('    Intersection as a fraction of atlas label volume : %0.1f%%' % a_perc)
+
+            if verbose:
+                print('  Atlas label %s (%d)' % (a_name, a_i))
+                print('    Atlas label volume : %0.1f ul' % a_vol_ul)
+                print('    Lesion-atlas label intersection volume : %0.1f ul' % intersect_vol_ul)
+                print('    Intersection as a fraction of lesion voume : %0.1f%%' % l_perc)
+                print('    Intersection as a fraction of atlas label volume : %0.1f%%' % a_perc)
 
             # Populate current row of results list
             lesion_results.append([l_name, a_name, l_vol_ul, a_vol_ul, intersect_vol_ul, l_perc, a_perc])
 
         results.append(lesion_results)
 
-    # Create HTML and CSV reports
-    out_dir = os.path.dirname(os.path.abspath(lesion_fname))
-    report_results(results, out_dir)
+    return results
 
-    # Clean exit
-    sys.exit(0)
 
+def subject_name(lesion_fname):
+    """
+    Subject identifier from lesion image filename (basename without Nifti extension)
+    """
+
+    name = os.path.basename(lesion_fname)
+    for ext in ('.gz', '.nii'):
+        if name.endswith(ext):
+            name = name[:-len(ext)]
+
+    return name
 
-def report_results(results, out_dir):
+
+def intersection_table(lesion, atlas, l_indices, hemi_xx):
+    """
+    Lesion-atlas intersection volumes for all lesion and split atlas label pairs
+    - lesion labels become a sparse one-hot [V x n_lesion] matrix over lesion voxels
+    - the atlas is reshaped to [V x 2 n_atlas] hemisphere split labels over the same voxels
+    - intersections and lesion volumes follow from one sparse-dense matrix product
+    - split atlas label volumes need every voxel and come from atlas_volumes
+
+    Parameters
+    ----------
+    lesion: 3D numpy integer array of lesion labels
+    atlas: 4D numpy float array of bilateral prob labels
+    l_indices: list of lesion label indices
+    hemi_xx: list of slices
+        left and right hemisphere x-ranges from split_brain
+
+    Returns
+    -------
+    l_vox: numpy array [n_lesion]
+        lesion label volumes in voxels
+    i_vox: numpy array [n_lesion x 2 n_atlas]
+        intersection volumes in voxels
+    """
+
+    n_lesion = len(l_indices)
+
+    # Lesion voxels and their labels
+    ix, iy, iz = np.nonzero(lesion)
+    l_vals = lesion[ix, iy, iz]
+
+    # One-hot column of each lesion voxel (voxels with labels missing from key are dropped)
+    l_indices = np.asarray(l_indices)
+    order = np.argsort(l_indices)
+    pos = np.searchsorted(l_indices[order], l_vals).clip(0, n_lesion - 1)
+    in_key = l_indices[order][pos] == l_vals
+    rows = np.flatnonzero(in_key)
+    cols = order[pos[in_key]]
+    onehot = sparse.csr_matrix((np.ones(rows.size), (rows, cols)), shape=(l_vals.size, n_lesion))
+
+    # Atlas restricted to lesion voxels, split into left and right hemisphere labels
+    # with a trailing column of ones for lesion volumes
+    a_lesion = np.asarray(atlas[ix, iy, iz, :], dtype=np.float64)
+    left = (ix >= hemi_xx[0].start) & (ix < hemi_xx[0].stop)
+    a_split = np.hstack([a_lesion * left[:, None],
+                         a_lesion * ~left[:, None],
+                         np.ones([l_vals.size, 1])])
+
+    # All lesion x atlas intersections and lesion volumes in a single product
+    prod = onehot.T.dot(a_split)
+    i_vox, l_vox = prod[:, :-1], prod[:, -1]
+
+    return l_vox, i_vox
+
+
+def atlas_volumes(atlas, hemi_xx):
+    """
+    Integrated split atlas label volumes in voxels, left then right hemisphere
+    - each hemisphere is reduced one label at a time to bound memory for mapped atlases
+    """
+
+    nl = atlas.shape[3]
+
+    a_vox = np.zeros(len(hemi_xx) * nl)
+    for h, xx in enumerate(hemi_xx):
+        for l in range(nl):
+            a_vox[h * nl + l] = np.sum(atlas[xx, :, :, l], dtype=np.float64)
+
+    return a_vox
+
+
+def report_results(results, out_dir, html=True):
+    """
+    Generate HTML plot report and CSV table of absolute and relative intersection volumes
+
+    Parameters
+    ----------
+    results: list of results lists
+    out_dir: output directory name
+    html: bool
+        render bokeh HTML report in addition to the CSV table
+
+    Returns
+    -------
+
+    """
+
+    import csv
+
+    if html:
+        report_html(results, out_dir)
+
+    # Write results to a CSV file
+    column_names = 'Lesion_Name', 'Atlas_Label', 'Lesion_Vol_ul', 'Atlas_Label_Vol_ul', 'Intersect_Vol_ul', 'Intersect_Lesion_%', 'Intersect_Atlas_Label_%'
+    csv_fname = os.path.join(out_dir, 'lesion_intersection_report.csv')
+    print('Exporting results table to %s' % csv_fname)
+
+    with open(csv_fname, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(column_names)
+        for lesion_results in results:
+            for atlas_result in lesion_results:
+                writer.writerow(atlas_result)
+
+
+def report_cohort(cohort_results, out_dir):
+    """
+    Write long-format CSV table of intersection volumes for a lesion cohort
+    - one row per subject, lesion label and atlas label
+
+    Parameters
+    ----------
+    cohort_results: list of (subject, results) tuples
+    out_dir: output directory name
+    """
+
+    import csv
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    column_names = 'Subject', 'Lesion_Name', 'Atlas_Label', 'Lesion_Vol_ul', 'Atlas_Label_Vol_ul', 'Intersect_Vol_ul', 'Intersect_Lesion_%', 'Intersect_Atlas_Label_%'
+    csv_fname = os.path.join(out_dir, 'lesion_cohort_report.csv')
+    print('Exporting cohort results table (%d subjects) to %s' % (len(cohort_results), csv_fname))
+
+    with open(csv_fname, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(column_names)
+        for subject, results in cohort_results:
+            for lesion_results in results:
+                for atlas_result in lesion_results:
+                    writer.writerow([subject] + atlas_result)
+
+
+def report_html(results, out_dir):
     """
     Generate HTML plot report of absolute and relative intersection volumes
 
@@ -195,7 +431,6 @@ def report_results(results, out_dir):
     from bokeh.layouts import gridplot
     from bokeh.charts import Bar, defaults
     import bokeh.palettes as bp
-    import csv
 
     # Init output HTML report page
     html_fname = os.path.join(out_dir, 'lesion_intersection_report.html')
@@ -275,18 +510,6 @@ def report_results(results, out_dir):
 
     show(gridplot(plots))
 
-    # Write results to a CSV file
-    column_names = 'Lesion_Name', 'Atlas_Label', 'Lesion_Vol_ul', 'Atlas_Label_Vol_ul', 'Intersect_Vol_ul', 'Intersect_Lesion_%', 'Intersect_Atlas_Label_%'
-    csv_fname = os.path.join(out_dir, 'lesion_intersection_report.csv')
-    print('Exporting results table to %s' % csv_fname)
-
-    with open(csv_fname, 'w', newline='') as csv_file:
-        writer = csv.writer(csv_file)
-        writer.writerow(column_names)
-        for lesion_results in results:
-            for atlas_result in lesion_results:
-                writer.writerow(atlas_result)
-
 
 def load_key(key_fname):
     """
@@ -320,7 +543,10 @@ def load_key(key_fname):
 def split_brain(atlas, atlas_key):
     """
     Split bilateral prob atlas into left and right hemisphere labels
-    Concatentate left and right labels into single atlas
+    - the split is lazy: left labels are the atlas with x >= hx zeroed and right
+      labels the atlas with x < hx zeroed, so only the x-range of each hemisphere
+      is returned and no split atlas is materialized
+    - split label a_c covers x-range hemi_xx[a_c // nl] of atlas volume a_c % nl
     Update atlas key accordingly
 
     Parameters
@@ -330,31 +556,20 @@ def split_brain(atlas, atlas_key):
 
     Returns
     -------
-
+    hemi_xx: list of slices
+        left and right hemisphere x-ranges
+    atlas_key_split: list
+        left then right hemisphere label keys
     """
 
     # Get atlas dimensions
-    nx, ny, nz, nl = atlas.shape
+    nx = atlas.shape[0]
 
     # Find sagittal midplane index
     hx = int(nx/2.0)
 
-    # Create left and right hemisphere masks
-    left_mask = np.ones([nx, ny, nz])
-    left_mask[hx:,:,:] = 0
-    right_mask = 1 - left_mask
-
-    # Create copies of the atlas
-    atlas_left = atlas.copy()
-    atlas_right = atlas.copy()
-
-    # Apply left and right masks to atlas copies
-    for l in range(0, nl):
-        atlas_left[:,:,:,l] = atlas[:,:,:,l] * left_mask
-        atlas_right[:,:,:,l] = atlas[:,:,:,l] * right_mask
-
-    # Concatenate left and right atlases
-    atlas_split = np.concatenate((atlas_left, atlas_right), axis=3)
+    # Left and right hemisphere x-ranges
+    hemi_xx = [slice(0, hx), slice(hx, nx)]
 
     atlas_key_left = []
     atlas_key_right = []
@@ -375,7 +590,7 @@ def split_brain(atlas, atlas_key):
     # Concatenate left and right label lists
     atlas_key_split = atlas_key_left + atlas_key_right
 
-    return atlas_split, atlas_key_split
+    return hemi_xx, atlas_key_split
 
 
 # This is the standard boilerplate that calls the main() function.
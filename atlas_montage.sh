@@ -4,16 +4,28 @@
 # AUTHOR : Mike Tyszka
 # PLACE  : Caltech
 # DATES  : 2017-05-23 JMT From scratch
+#          2026-10-18 Optional target pixel size selects preview pyramid levels (atlas_pyramid.py)
 
 if [ $# -lt 3 ]
 then
-  echo "USAGE : atlas_montage.sh <4D prob atlas> <3D structural template> <p threshold>"
+  echo "USAGE : atlas_montage.sh <4D prob atlas> <3D structural template> <p threshold> [<target pixel size (mm)>]"
   exit
 fi
 
 PROB=$1
 STRUCT=$2
 THRESH=$3
+TARGET=$4
+
+# Substitute coarsest preview pyramid levels meeting the target pixel size
+if [ -n "${TARGET}" ]
+then
+  PYR_DIR=`dirname ${PROB}`/pyramid
+  LEVELS=(`atlas_pyramid.py -s ${TARGET} -o ${PYR_DIR} ${PROB} ${STRUCT}`)
+  PROB=${LEVELS[0]}
+  STRUCT=${LEVELS[1]}
+  echo "Using ${PROB} and ${STRUCT}"
+fi
 
 # Colormap for deterministic atlas overlay
 LUT=${FSLDIR}/etc/luts/striatum-con-7sub.lut
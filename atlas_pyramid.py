@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Build and select multi-resolution preview pyramids of atlas images
+- block-averaged 2x, 4x and 8x downsampled copies of 3D templates and 4D prob atlases
+- block averaging preserves probability mass (sum x block volume)
+- rendering tools pick the coarsest level that still meets their target pixel size
+
+Usage
+----
+atlas_pyramid.py <image> [<image> ...]
+atlas_pyramid.py -s <target pixel size (mm)> <image> [<image> ...]
+atlas_pyramid.py -h
+
+Example
+----
+>>> atlas_pyramid.py prob_atlas.nii.gz ${CIT168_DIR}/CIT168_700um/CIT168_T1w_700um.nii.gz -o pyramid
+>>> atlas_pyramid.py -s 1.5 -o pyramid prob_atlas.nii.gz
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+Dates
+----
+2026-10-18 From scratch
+
+License
+----
+This file is part of atlaskit.
+
+    atlaskit is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    atlaskit is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with atlaskit.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright
+----
+2026 California Institute of Technology.
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.fileslice import fileslice
+
+__version__ = '0.1.0'
+
+# Downsampling factors of pyramid levels
+PYRAMID_FACTORS = (2, 4, 8)
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Build or select block-averaged preview pyramid levels')
+    parser.add_argument('images', nargs='+', help='3D or 4D Nifti images')
+    parser.add_argument('-o', '--outdir', required=False,
+                        help='Pyramid directory [<image directory>/pyramid]')
+    parser.add_argument('-f', '--factors', required=False, default='2,4,8',
+                        help='Comma separated downsampling factors [2,4,8]')
+    parser.add_argument('-s', '--select', required=False, type=float,
+                        help='Print coarsest level common to all images with voxels no larger than this size (mm)')
+
+    # Parse command line arguments
+    args = parser.parse_args()
+    factors = tuple(int(f) for f in args.factors.split(','))
+
+    if args.select:
+
+        # Print level for each image at a common factor (used by shell scripts)
+        f = select_factor(args.images, args.select, factors, args.outdir)
+        for fname in args.images:
+            print(pyramid_fname(fname, f, args.outdir))
+
+    else:
+
+        for fname in args.images:
+            build_pyramid(fname, factors, args.outdir)
+
+    # Clean exit
+    sys.exit(0)
+
+
+def build_pyramid(fname, factors=PYRAMID_FACTORS, pyr_dir=None):
+    """
+    Build block-averaged pyramid levels for a 3D or 4D image
+    - 4D images are streamed one volume at a time through a single open file
+
+    Parameters
+    ----------
+    fname: string
+        Nifti image filename
+    factors: tuple
+        integer downsampling factors
+    pyr_dir: string
+        pyramid directory [<image directory>/pyramid]
+
+    Returns
+    -------
+    level_fnames: list
+        pyramid level filenames in factor order
+    """
+
+    print('Building pyramid for %s' % fname)
+
+    nii = nib.load(fname)
+    shape = nii.shape
+    nt = shape[3] if len(shape) > 3 else 1
+
+    # Downsampled volumes for each factor
+    levels = []
+    for f in factors:
+        ds_shape = tuple(int(np.ceil(n / float(f))) for n in shape[:3])
+        levels.append(np.zeros(ds_shape + shape[3:], dtype=np.float32))
+
+    # Read each volume once and downsample to all levels
+    for t, vol in enumerate(stream_volumes(nii)):
+        for f, level in zip(factors, levels):
+            level.reshape(level.shape[:3] + (nt,))[..., t] = block_average(vol, f)
+
+    level_fnames = []
+    for f, level in zip(factors, levels):
+
+        level_fname = pyramid_fname(fname, f, pyr_dir)
+        os.makedirs(os.path.dirname(level_fname), exist_ok=True)
+
+        print('  Saving %dx level to %s' % (f, level_fname))
+        level_nii = nib.Nifti1Image(level, downsample_affine(nii.affine, f))
+        level_nii.header.set_xyzt_units(*nii.header.get_xyzt_units())
+        level_nii.to_filename(level_fname)
+
+        level_fnames.append(level_fname)
+
+    return level_fnames
+
+
+def stream_volumes(nii):
+    """
+    Yield scaled 3D volumes of an image in file order
+    - volumes are contiguous on disk (Fortran order), so reading them in order
+      from one open file never rewinds, even for gzipped images
+
+    Parameters
+    ----------
+    nii: Nifti image opened with nib.load
+
+    Yields
+    ------
+    vol: 3D numpy array
+    """
+
+    proxy = nii.dataobj
+    shape, dtype, offset = proxy.shape, proxy.dtype, proxy.offset
+    nt = int(np.prod(shape[3:]))
+
+    with ImageOpener(nii.get_filename(), 'rb') as fobj:
+        for t in range(nt):
+            tt = np.unravel_index(t, shape[3:], order='F') if len(shape) > 3 else ()
+            sliceobj = (slice(None),) * 3 + tuple(int(i) for i in tt)
+            raw = fileslice(fobj, sliceobj, shape, dtype, offset, order='F')
+            yield raw * proxy.slope + proxy.inter
+
+
+def block_average(vol, f):
+    """
+    Downsample a 3D volume by averaging non-overlapping f x f x f blocks
+    - volume is zero padded to a multiple of f, so block sums (mass) are preserved
+
+    Parameters
+    ----------
+    vol: 3D numpy array
+    f: int
+        downsampling factor
+
+    Returns
+    -------
+    ds: 3D numpy float32 array
+    """
+
+    nx, ny, nz = vol.shape
+    mx, my, mz = [int(np.ceil(n / float(f))) for n in (nx, ny, nz)]
+
+    padded = np.zeros([mx * f, my * f, mz * f], dtype=np.float32)
+    padded[:nx, :ny, :nz] = vol
+
+    return padded.reshape(mx, f, my, f, mz, f).mean(axis=(1, 3, 5))
+
+
+def downsample_affine(affine, f):
+    """
+    Voxel to world transform of block-averaged level
+    - voxel size scaled by f, origin moved to center of first block
+    """
+
+    ds_affine = affine.copy()
+    ds_affine[:3, :3] = affine[:3, :3] * f
+    ds_affine[:3, 3] = affine[:3, :3].dot(np.ones(3) * (f - 1) / 2.0) + affine[:3, 3]
+
+    return ds_affine
+
+
+def pyramid_fname(fname, f, pyr_dir=None):
+    """
+    Filename of pyramid level f for an image (f = 1 is the image itself)
+    """
+
+    if f == 1:
+        return fname
+
+    if not pyr_dir:
+        pyr_dir = os.path.join(os.path.dirname(os.path.abspath(fname)), 'pyramid')
+
+    stub = os.path.basename(fname)
+    for ext in ('.gz', '.nii'):
+        if stub.endswith(ext):
+            stub = stub[:-len(ext)]
+
+    return os.path.join(pyr_dir, '%s_ds%d.nii.gz' % (stub, f))
+
+
+def available_factors(fname, factors=PYRAMID_FACTORS, pyr_dir=None):
+    """
+    Pyramid factors with level files at least as recent as the source image
+    """
+
+    src_mtime = os.path.getmtime(fname)
+
+    avail = [1]
+    for f in factors:
+        level_fname = pyramid_fname(fname, f, pyr_dir)
+        if os.path.isfile(level_fname) and os.path.getmtime(level_fname) >= src_mtime:
+            avail.append(f)
+
+    return avail
+
+
+def select_factor(fnames, target_mm, factors=PYRAMID_FACTORS, pyr_dir=None):
+    """
+    Coarsest pyramid factor available for all images whose voxel size
+    does not exceed the target pixel size
+
+    Parameters
+    ----------
+    fnames: list of strings
+        Nifti image filenames to be rendered together
+    target_mm: float
+        target pixel size in mm
+    factors: tuple
+        candidate downsampling factors
+    pyr_dir: string
+        pyramid directory [<image directory>/pyramid]
+
+    Returns
+    -------
+    f: int
+        selected downsampling factor (1 = full resolution)
+    """
+
+    # Factors available for every image
+    common = set(factors) | {1}
+    vox_mm = 0.0
+    for fname in fnames:
+        common &= set(available_factors(fname, factors, pyr_dir))
+        vox_mm = max(vox_mm, max(nib.load(fname).header.get_zooms()[:3]))
+
+    fits = [f for f in common if f * vox_mm <= target_mm]
+
+    return max(fits) if fits else 1
+
+
+def select_level(fname, target_mm, factors=PYRAMID_FACTORS, pyr_dir=None):
+    """
+    Coarsest available pyramid level of an image meeting the target pixel size
+
+    Returns
+    -------
+    level_fname: string
+        selected level filename
+    f: int
+        selected downsampling factor
+    """
+
+    f = select_factor([fname], target_mm, factors, pyr_dir)
+
+    return pyramid_fname(fname, f, pyr_dir), f
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()
@@ -41,18 +41,31 @@ Copyright
 
 import os
 import sys
+import copy
+import json
+import gzip
+import shutil
+import hashlib
 import argparse
 import jinja2
 import colorsys
+import multiprocessing as mp
 import numpy as np
 import nibabel as nib
 import matplotlib.pyplot as plt
 from datetime import datetime
-from skimage.util.montage import montage2d
 from skimage import color
-from atlas import get_label_name
+from atlas import get_label_name, load_metrics_store
+from atlas_pyramid import select_factor, pyramid_fname, PYRAMID_FACTORS
 __version__ = '1.1'
 
+# In-process cache of loaded volumes shared by report functions
+# keyed by (path, mtime, ...) so modified files are reloaded
+_volume_cache = {}
+
+# Report artefact manifest: input fingerprint for each output file in report directory
+_manifest = {}
+
 
 def main():
 
@@ -60,11 +73,14 @@ def main():
     parser = argparse.ArgumentParser(description='Create labeling report for a probabilistic atlas')
     parser.add_argument('-a', '--atlasdir', required=True, help='Directory containing probabilistic atlas')
     parser.add_argument('--strip', dest='strip', action='store_true', help='Strep prefixes from label names')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of parallel figure rendering processes [1]')
+    parser.add_argument('--force', dest='force', action='store_true', help='Rebuild all report artefacts, ignoring manifest')
     
     # Parse command line arguments
     args = parser.parse_args()
     atlas_dir = args.atlasdir
     strip_prefix = args.strip
+    n_jobs = args.jobs
     
     print('')
     print('-----------------------------')
@@ -88,20 +104,27 @@ def main():
     print('Loading similarity metrics')
     intra_stats, inter_stats = load_metrics(atlas_dir)
 
+    # Fingerprints of existing report artefacts
+    if not args.force:
+        load_manifest(report_dir)
+
     # Intra-observer reports (one per observer)
     print('')
     print('Generating intra-observer reports')
-    obs_reports = intra_observer_reports(atlas_dir, report_dir, intra_stats, strip_prefix)
+    obs_reports = intra_observer_reports(atlas_dir, report_dir, intra_stats, strip_prefix, n_jobs)
+    save_manifest(report_dir)
 
     # Inter-observer report
     print('')
     print('Generating inter-observer report')
-    inter_observer_report(report_dir, inter_stats, strip_prefix)
+    inter_observer_report(report_dir, inter_stats, strip_prefix, n_jobs)
+    save_manifest(report_dir)
 
     # Summary report page
     print('')
     print('Writing report summary page')
     summary_report(atlas_dir, report_dir, intra_stats, inter_stats, obs_reports, strip_prefix)
+    save_manifest(report_dir)
 
     # Clean exit
     sys.exit(0)
@@ -137,25 +160,25 @@ def summary_report(atlas_dir, report_dir, intra_metrics, inter_metrics, obs_repo
 
     # Create grand prob label overlays on bg image
     print('  Generating probability montages')
-    montage_fname = overlay_montage(atlas_dir, report_dir, 'prob_atlas.nii.gz')
-    colorkey_fname = create_colorkey(atlas_dir, report_dir, 'prob_atlas.nii.gz', strip_prefix)
+    prob_fname = 'prob_atlas.nii.gz'
+    montage_fname, = render_jobs(overlay_montage, [(atlas_dir, report_dir, prob_fname)],
+                                 outputs=[os.path.join(report_dir, montage_name(prob_fname))],
+                                 inputs=[montage_inputs(atlas_dir, prob_fname)])
+    colorkey_fname, = render_jobs(create_colorkey, [(atlas_dir, report_dir, prob_fname, strip_prefix)],
+                                  outputs=[os.path.join(report_dir, colorkey_name(prob_fname))],
+                                  inputs=[colorkey_inputs(atlas_dir, prob_fname)])
 
     # Template variables
     template_vars = {
         "obs_reports": obs_reports,
         "montage_fname": montage_fname,
-        "colorkey_fname": colorkey_fname,
-        "report_time": datetime.now().strftime('%Y-%m-%d %H:%M')}
+        "colorkey_fname": colorkey_fname}
 
-    # Finally, process the template to produce our final text.
-    output_text = html.render(template_vars)
+    # Process the template and write page to report directory
+    write_page(report_dir, 'index.html', html, template_vars)
 
-    # Write page to report directory
-    with open(os.path.join(os.path.join(atlas_dir), 'report', 'index.html'), "w") as f:
-        f.write(output_text)
 
-
-def intra_observer_reports(atlas_dir, report_dir, intra_metrics, strip_prefix):
+def intra_observer_reports(atlas_dir, report_dir, intra_metrics, strip_prefix, n_jobs=1):
     """
     Generate intra-observer report for each observer
 
@@ -167,6 +190,8 @@ def intra_observer_reports(atlas_dir, report_dir, intra_metrics, strip_prefix):
         report directory path
     intra_metrics: tuple
         containing labelNames, labelNos, observers, templates, dice and haussdorff metrics
+    n_jobs: int
+        number of parallel figure rendering processes
 
     Returns
     -------
@@ -196,25 +221,33 @@ def intra_observer_reports(atlas_dir, report_dir, intra_metrics, strip_prefix):
     intra_haus_imgs = []
     obs_reports = []
 
+    # Figure and montage rendering jobs, run once all observers are compiled
+    figure_jobs = []
+    montage_jobs = []
+    obs_html_vars = []
+
+    label_names = list(label_names)
+
     for obs in observers:
 
         print('')
         print('Observer %02d' % obs)
 
-        # Generate Dice and Hausdorf similarity matrix figures
+        # Dice and Hausdorf similarity matrix figures
+        # Only pass this observer's metric slice to the renderer
 
         dice_fname = "intra_obs_%02d_dice.png" % obs
-        similarity_figure(dice[:,obs,:,:],
-                          "Observer %02d Dice Coefficient" % obs,
-                          dice_fname,
-                          report_dir, label_names, dlims, nrows, ncols, 0.0, 12, strip_prefix)
+        figure_jobs.append((np.array(dice[:,obs,:,:]),
+                            "Observer %02d Dice Coefficient" % obs,
+                            dice_fname,
+                            report_dir, label_names, dlims, nrows, ncols, 0.0, 12, strip_prefix))
         intra_dice_imgs.append(dice_fname)
 
         haus_fname = "intra_obs_%02d_haus.png" % obs
-        similarity_figure(haus[:,obs,:,:],
-                          "Observer %02d Hausdorff Distance (mm)" % obs,
-                          haus_fname,
-                          report_dir, label_names, hlims, nrows, ncols, 1e6, 12, strip_prefix)
+        figure_jobs.append((np.array(haus[:,obs,:,:]),
+                            "Observer %02d Hausdorff Distance (mm)" % obs,
+                            haus_fname,
+                            report_dir, label_names, hlims, nrows, ncols, 1e6, 12, strip_prefix))
         intra_haus_imgs.append(haus_fname)
 
         # Compile stats results for each label for this observer
@@ -245,32 +278,39 @@ def intra_observer_reports(atlas_dir, report_dir, intra_metrics, strip_prefix):
             obs_stats.append(label_dict)
 
         # Mean label overlay montage
-        print('  Generating mean label montage')
-        montage_fname = overlay_montage(atlas_dir, report_dir, 'obs-{0:02d}_label_mean.nii.gz'.format(obs))
+        montage_jobs.append((atlas_dir, report_dir, 'obs-{0:02d}_label_mean.nii.gz'.format(obs)))
 
-        # Template variables
-        html_vars = {
+        # Template variables (montage filename added after rendering)
+        obs_html_vars.append({
             "obs": "{0:02d}".format(obs),
-            "montage_fname": montage_fname,
             "dice_fname": dice_fname,
             "haus_fname": haus_fname,
-            "obs_stats": obs_stats,
-            "report_time": datetime.now().strftime('%Y-%m-%d %H:%M')
-        }
+            "obs_stats": obs_stats
+        })
+
+    # Render all similarity figures and mean label montages
+    print('')
+    print('  Rendering %d figures and %d mean label montages' % (len(figure_jobs), len(montage_jobs)))
+    render_jobs(similarity_figure, figure_jobs, n_jobs,
+                outputs=[os.path.join(report_dir, job[2]) for job in figure_jobs])
+    montage_fnames = render_jobs(overlay_montage, montage_jobs, n_jobs,
+                                 outputs=[os.path.join(report_dir, montage_name(job[2])) for job in montage_jobs],
+                                 inputs=[montage_inputs(atlas_dir, job[2]) for job in montage_jobs])
+
+    # Assemble observer pages once all images are ready
+    for obs, html_vars, montage_fname in zip(observers, obs_html_vars, montage_fnames):
 
-        # Render page
-        html_text = html.render(html_vars)
+        html_vars["montage_fname"] = montage_fname
 
-        # Write report
+        # Render and write report
         obs_html = "observer_%02d_report.html" % obs
-        with open(os.path.join(report_dir, obs_html), "w") as f:
-            f.write(html_text)
+        write_page(report_dir, obs_html, html, html_vars)
         obs_reports.append(dict(fname=obs_html, obs="{0:02d}".format(obs)))
 
     return obs_reports
 
 
-def inter_observer_report(report_dir, inter_metrics, strip_prefix):
+def inter_observer_report(report_dir, inter_metrics, strip_prefix, n_jobs=1):
     """
     Generate inter-observer report for each template
 
@@ -278,6 +318,7 @@ def inter_observer_report(report_dir, inter_metrics, strip_prefix):
     ----------
     report_dir: report directory path
     inter_metrics: tuple containing labelNames, labelNos, observers, templates, dice and haussdorff metrics
+    n_jobs: number of parallel figure rendering processes
 
     Returns
     -------
@@ -305,25 +346,33 @@ def inter_observer_report(report_dir, inter_metrics, strip_prefix):
     # Init image filename lists for HTML template
     inter_dice_imgs = []
     inter_haus_imgs = []
+    figure_jobs = []
 
-    # Loop over all templates, constructing dice and haus matrix images
+    label_names = list(label_names)
+
+    # Loop over all templates, constructing dice and haus matrix figure jobs
     for tt in templates:
 
         # Create similarity figures over all labels and observers
         dice_fname = "inter_tmp_%02d_dice.png" % tt
-        similarity_figure(dice[:,tt,:,:],
-                          "Template %02d : Dice Coefficient" % tt,
-                          dice_fname,
-                          report_dir, label_names, dlims, nrows, ncols, 0.0, 12, strip_prefix)
+        figure_jobs.append((np.array(dice[:,tt,:,:]),
+                            "Template %02d : Dice Coefficient" % tt,
+                            dice_fname,
+                            report_dir, label_names, dlims, nrows, ncols, 0.0, 12, strip_prefix))
         inter_dice_imgs.append(dice_fname)
 
         haus_fname = "inter_tmp_%02d_haus.png" % tt
-        similarity_figure(haus[:,tt,:,:],
-                          "Template %02d Hausdorff Distance (mm)" % tt,
-                          haus_fname,
-                          report_dir, label_names, hlims, nrows, ncols, 1e6, 12, strip_prefix)
+        figure_jobs.append((np.array(haus[:,tt,:,:]),
+                            "Template %02d Hausdorff Distance (mm)" % tt,
+                            haus_fname,
+                            report_dir, label_names, hlims, nrows, ncols, 1e6, 12, strip_prefix))
         inter_haus_imgs.append(haus_fname)
 
+    # Render all similarity figures before assembling page
+    print('  Rendering %d figures' % len(figure_jobs))
+    render_jobs(similarity_figure, figure_jobs, n_jobs,
+                outputs=[os.path.join(report_dir, job[2]) for job in figure_jobs])
+
     # Composite all images into a single dictionary list
     inter_imgs = []
     for i, dimg in enumerate(inter_dice_imgs):
@@ -331,18 +380,219 @@ def inter_observer_report(report_dir, inter_metrics, strip_prefix):
         inter_imgs.append(dict(dimg=dimg, himg=himg))
 
     # Template variables
-    html_vars = {"inter_imgs": inter_imgs,
-                 "report_time": datetime.now().strftime('%Y-%m-%d %H:%M')}
-
-    # Render page
-    html_text = html.render(html_vars)
+    html_vars = {"inter_imgs": inter_imgs}
 
-    # Write report
-    obs_html = os.path.join(report_dir, "inter_report.html")
-    with open(obs_html, "w") as f:
-        f.write(html_text)
+    # Render and write report
+    write_page(report_dir, "inter_report.html", html, html_vars)
 
         
+def render_jobs(func, jobs, n_jobs=1, outputs=None, inputs=None):
+    """
+    Run figure rendering jobs serially or in a process pool using the Agg backend
+    - jobs whose output exists with unchanged input fingerprint in the manifest are skipped
+
+    Parameters
+    ----------
+    func: function
+        rendering function
+    jobs: list of tuples
+        argument tuples for each call of func
+    n_jobs: int
+        number of worker processes
+    outputs: list of strings
+        output file path for each job (None disables skipping)
+    inputs: list
+        additional inputs for each job fingerprint (eg file fingerprints)
+
+    Returns
+    -------
+    res: list
+        return values of func in job order (output filename for skipped jobs)
+    """
+
+    if outputs is None:
+        outputs = [None] * len(jobs)
+    if inputs is None:
+        inputs = [None] * len(jobs)
+
+    # Input fingerprint for each job
+    fps = [fingerprint(func.__name__, __version__, job, extra) for job, extra in zip(jobs, inputs)]
+
+    res = [None] * len(jobs)
+    todo = []
+    for jc, (out_path, fp) in enumerate(zip(outputs, fps)):
+        if out_path and is_current(out_path, fp):
+            res[jc] = os.path.basename(out_path)
+        else:
+            todo.append(jc)
+
+    if len(todo) < len(jobs):
+        print('  Skipping %d unchanged artefacts' % (len(jobs) - len(todo)))
+
+    todo_jobs = [jobs[jc] for jc in todo]
+
+    if n_jobs > 1 and len(todo_jobs) > 1:
+        with mp.Pool(min(n_jobs, len(todo_jobs)), initializer=_init_render_worker) as pool:
+            todo_res = pool.starmap(func, todo_jobs)
+    else:
+        todo_res = [func(*job) for job in todo_jobs]
+
+    # Record fingerprints of rebuilt artefacts
+    for jc, r in zip(todo, todo_res):
+        res[jc] = r
+        if outputs[jc]:
+            _manifest[os.path.basename(outputs[jc])] = fps[jc]
+
+    return res
+
+
+def write_page(report_dir, page_fname, html, html_vars):
+    """
+    Render HTML page from Jinja2 template and write to report directory
+    - skipped if page exists with unchanged template and variables
+
+    Parameters
+    ----------
+    report_dir: string
+        report directory path
+    page_fname: string
+        HTML page filename within report directory
+    html: jinja2 template
+    html_vars: dictionary
+        template variables (report time is added on rendering)
+    """
+
+    page_path = os.path.join(report_dir, page_fname)
+
+    fp = fingerprint('write_page', __version__, file_fingerprint(html.filename), html_vars)
+
+    if is_current(page_path, fp):
+        print('  Skipping unchanged page %s' % page_fname)
+        return
+
+    html_vars = dict(html_vars, report_time=datetime.now().strftime('%Y-%m-%d %H:%M'))
+
+    with open(page_path, "w") as f:
+        f.write(html.render(html_vars))
+
+    _manifest[page_fname] = fp
+
+
+def fingerprint(*parts):
+    """
+    SHA1 hash of rendering inputs (arrays, strings, numbers and nested containers)
+    """
+
+    h = hashlib.sha1()
+
+    def _update(x):
+        if isinstance(x, np.ndarray):
+            h.update(str((x.dtype.str, x.shape)).encode())
+            h.update(np.ascontiguousarray(x).tobytes())
+        elif isinstance(x, (list, tuple)):
+            h.update(b'[')
+            for xx in x:
+                _update(xx)
+            h.update(b']')
+        elif isinstance(x, dict):
+            h.update(b'{')
+            for k in sorted(x):
+                _update(k)
+                _update(x[k])
+            h.update(b'}')
+        else:
+            h.update(repr(x).encode())
+        h.update(b',')
+
+    _update(parts)
+
+    return h.hexdigest()
+
+
+def file_fingerprint(fname):
+    """
+    Input file fingerprint from real path, modification time and size
+    """
+
+    if not os.path.isfile(fname):
+        return 'missing', fname
+
+    st = os.stat(fname)
+
+    return os.path.realpath(fname), st.st_mtime, st.st_size
+
+
+def montage_inputs(atlas_dir, overlay_fname):
+    """
+    Input files for an overlay montage, including any preview pyramid levels
+    """
+
+    p_fname = os.path.join(atlas_dir, overlay_fname)
+    bg_fname = os.path.join(os.environ['CIT168_DIR'], 'CIT168_700um', 'CIT168_T1w_700um.nii.gz')
+    pyr_dir = os.path.join(atlas_dir, 'pyramid')
+
+    inputs = [file_fingerprint(os.path.join(atlas_dir, 'labels.txt'))]
+    for fname in (p_fname, bg_fname):
+        for f in (1,) + PYRAMID_FACTORS:
+            inputs.append(file_fingerprint(pyramid_fname(fname, f, pyr_dir)))
+
+    return inputs
+
+
+def colorkey_inputs(atlas_dir, overlay_fname):
+    """
+    Input files for a label color key
+    """
+
+    return [file_fingerprint(os.path.join(atlas_dir, overlay_fname)),
+            file_fingerprint(os.path.join(atlas_dir, 'labels.txt'))]
+
+
+def montage_name(overlay_fname):
+    return overlay_fname.replace('.nii.gz', '_montage.png')
+
+
+def colorkey_name(overlay_fname):
+    return overlay_fname.replace('.nii.gz', '_colorkey.png')
+
+
+def is_current(out_path, fp):
+    """
+    Check whether output artefact exists and was built from identical inputs
+    """
+
+    return os.path.isfile(out_path) and _manifest.get(os.path.basename(out_path)) == fp
+
+
+def load_manifest(report_dir):
+    """
+    Load report artefact manifest from report directory
+    """
+
+    manifest_fname = os.path.join(report_dir, 'manifest.json')
+
+    if os.path.isfile(manifest_fname):
+        with open(manifest_fname, 'r') as f:
+            _manifest.update(json.load(f))
+
+
+def save_manifest(report_dir):
+    """
+    Save report artefact manifest to report directory
+    """
+
+    with open(os.path.join(report_dir, 'manifest.json'), 'w') as f:
+        json.dump(_manifest, f, indent=2, sort_keys=True)
+
+
+def _init_render_worker():
+    """
+    Non-interactive matplotlib backend for rendering worker processes
+    """
+
+    plt.switch_backend('Agg')
+
+
 def do_strip_prefixes(label_names):
     # if desired, remove prefixes from label names 
     stripped_label_names = []
@@ -397,76 +647,91 @@ def overlay_montage(atlas_dir, report_dir, overlay_fname):
     # Size of coronal section montage
     n_rows, n_cols = 6, 6
 
-    # Load background image
-    print('  Loading background image')
-    bg_fname = os.path.join(cit_dir, 'CIT168_700um', 'CIT168_T1w_700um.nii.gz')
-    bg_nii = nib.load(bg_fname)
-    bg_img = bg_nii.get_data()
+    # Montage figure size (inches) and resolution (dpi)
+    fig_size, fig_dpi = (15, 10), 100
 
-    # Normalize background intensity range to [0,1]
-    bg_img = bg_img / np.max(bg_img)
+    # Background image
+    bg_fname = os.path.join(cit_dir, 'CIT168_700um', 'CIT168_T1w_700um.nii.gz')
 
-    # Load the 4D probabilistic atlas
-    print('  Loading probabilistic image')
-    p_nii = nib.load(os.path.join(atlas_dir, overlay_fname))
-    p_atlas = p_nii.get_data()
+    # Uncompressed cache for slice-selective reads
+    cache_dir = os.path.join(report_dir, 'cache')
+    p_fname = os.path.join(atlas_dir, overlay_fname)
 
-    # Count prob labels
-    n_labels = p_atlas.shape[3]
+    # Count prob labels from header
+    n_labels = cached_header(p_fname).get_data_shape()[3]
 
     # Find minimum bounding box for all prob labels > 0.25
     # x0, y0, z0 : minimum corner of BB (closest to origin)
+    # Projections are cached alongside the uncompressed atlas
     print('  Determining minimum isotropic bounding box')
-    p_all = np.sum(p_atlas, axis=3)
-    x0, x1, y0, y1, z0, z1 = bb(p_all > p_thresh, padding=4)
-
-    # Crop bg image and prob atlas
-    bg_crop = bg_img[x0:x1, y0:y1, z0:z1]
-    p_crop = p_atlas[x0:x1, y0:y1, z0:z1, :]
+    p_summary = volume_summary(p_fname, cache_dir, p_thresh)
+    bbox = bb_projections(p_summary['xproj'], p_summary['yproj'], p_summary['zproj'], padding=4)
+    x0, x1, y0, y1, z0, z1 = bbox
+
+    # Use coarsest preview pyramid level (see atlas_pyramid.py) that meets montage pixel size
+    # Each (z1 - z0) x (x1 - x0) section tile is shown at the smaller of its width and height
+    # shares of the figure, so the target is the tile extent in mm per displayed tile pixel
+    # Typical ROIs are magnified on screen and stay at full resolution; a 2x level is only
+    # used once two or more voxels fall on each displayed pixel
+    pyr_dir = os.path.join(atlas_dir, 'pyramid')
+    vox_mm = max(cached_header(p_fname).get_zooms()[:3])
+    tile_w_px = fig_size[0] * fig_dpi / float(n_cols)
+    tile_h_px = fig_size[1] * fig_dpi / float(n_rows)
+    tile_px_per_vox = min(tile_w_px / (x1 - x0), tile_h_px / (z1 - z0))
+    target_mm = vox_mm / tile_px_per_vox
+    f = select_factor([p_fname, bg_fname], target_mm, pyr_dir=pyr_dir)
+    if f > 1:
+        print('  Using %dx downsampled pyramid level' % f)
+        p_fname = pyramid_fname(p_fname, f, pyr_dir)
+        bg_fname = pyramid_fname(bg_fname, f, pyr_dir)
+        # Floor lower bounds, ceil exclusive upper bounds (clamped to level shape)
+        # so no ROI voxels are clipped
+        level_shape = cached_header(p_fname).get_data_shape()[:3]
+        bbox = tuple(int(b) // f if i % 2 == 0 else min(-(-int(b) // f), level_shape[i // 2])
+                     for i, b in enumerate(bbox))
+        x0, x1, y0, y1, z0, z1 = bbox
+
+    # Coronal sections used by the montage
+    yy = y0 + montage_sections(y1 - y0, n_rows * n_cols)
+
+    # Read only montage sections of normalized bg image and prob atlas
+    print('  Loading %d coronal sections' % yy.size)
+    bg_crop = cached_background(bg_fname, bbox, yy, cache_dir)
+    p_crop = read_sections(p_fname, cache_dir, bbox, yy)
 
     # Create montage of coronal sections through cropped bg image
     bg_mont = coronal_montage(bg_crop, n_rows, n_cols)
 
-    bg_mont_rgb = tint(bg_mont, hue=0.0, saturation=0.0)
+    # Grayscale background
+    bg_mont_rgb = np.dstack((bg_mont, bg_mont, bg_mont))
 
-    # Initialize the all-label overlay
-    overlay_mont_rgb = np.zeros_like(bg_mont_rgb)
+    # Create equivalent montages for all prob labels at once (rows x cols x n_labels)
+    p_mont = coronal_montage(p_crop, n_rows, n_cols)
 
-    # Create equivalent montage for all prob labels with varying hues
-    for lc in range(0, n_labels):
+    # RGB color for each label (n_labels x 3)
+    rgb_colors = label_colors(n_labels, hsv, atlas_color)
 
-        # Construct prob label montage
-        p_mont = coronal_montage(p_crop[:,:,:,lc], n_rows, n_cols)
-
-        # Hue and saturation for label overlay
-        if atlas_color:
-            # Pull HSV from ITK-SNAP label key
-            hue, sat, val = hsv[lc, 0], hsv[lc, 1], hsv[lc,2]
-        else:
-            # Calculate rotating hue
-            hue = float(np.mod(lc * 3, n_labels)) / n_labels
-            sat, val = 1.0, 1.0
-
-        # Tint the montage
-        p_mont_rgb = tint(p_mont, hue=hue, saturation=sat, value=val)
-
-        # Add tinted overlay to running total
-        overlay_mont_rgb += p_mont_rgb
+    # Tinted overlay of all labels as a single contraction over labels
+    # HSV to RGB is linear in value, so each label contributes p * RGB color
+    overlay_mont_rgb = np.tensordot(p_mont, rgb_colors, axes=([2], [0]))
 
     # Composite prob atlas overlay on bg image
     mont_rgb = composite(overlay_mont_rgb, bg_mont_rgb)
 
     # Create figure and render montage
-    fig = plt.figure(figsize=(15,10), dpi=100)
+    fig = plt.figure(figsize=fig_size, dpi=fig_dpi)
     plt.imshow(mont_rgb, interpolation='none')
     plt.axis('off')
     plt.legend()
     
     # Save figure to PNG
-    montage_fname = overlay_fname.replace('.nii.gz', '_montage.png')
+    montage_fname = montage_name(overlay_fname)
     print('  Saving image to %s' % montage_fname)
     plt.savefig(os.path.join(report_dir, montage_fname), bbox_inches='tight')
 
+    # Clean up
+    plt.close(fig)
+
     return montage_fname
 
 
@@ -502,31 +767,11 @@ def create_colorkey(atlas_dir, report_dir, overlay_fname, strip_prefix):
     # Extract HSV label colors (n_labels x 3 array)
     hsv = label_rgb2hsv(label_key)
 
-    # Load the 4D probabilistic atlas
-    print('  Loading probabilistic image')
-    p_nii = nib.load(os.path.join(atlas_dir, overlay_fname))
-    p_atlas = p_nii.get_data()
-
-    # Count prob labels
-    n_labels = p_atlas.shape[3]
-
-    rgb_colors = []
-    labels = []
-    # Create equivalent montage for all prob labels with varying hues
-    for lc in range(0, n_labels):
-
-        # Hue and saturation for label overlay
-        if atlas_color:
-            # Pull HSV from ITK-SNAP label key
-            hue, sat, val = hsv[lc, 0], hsv[lc, 1], hsv[lc,2]
-        else:
-            # Calculate rotating hue
-            hue = float(np.mod(lc * 3, n_labels)) / n_labels
-            sat, val = 1.0, 1.0
-        rgb = colorsys.hsv_to_rgb(hue, sat, val)
-        rgb_colors.append(rgb)
+    # Count prob labels from the 4D probabilistic atlas header
+    n_labels = cached_header(os.path.join(atlas_dir, overlay_fname)).get_data_shape()[3]
 
-    rgb_color_array = np.array(rgb_colors)
+    # RGB color for each label (n_labels x 3)
+    rgb_color_array = label_colors(n_labels, hsv, atlas_color)
     
     x = np.array([0] * n_labels)
     y = np.linspace(1, n_labels, n_labels)
@@ -544,13 +789,258 @@ def create_colorkey(atlas_dir, report_dir, overlay_fname, strip_prefix):
             
     
     # Save figure to PNG
-    colorkey_fname = overlay_fname.replace('.nii.gz', '_colorkey.png')
+    colorkey_fname = colorkey_name(overlay_fname)
     print('  Saving image to %s' % colorkey_fname)
     plt.savefig(os.path.join(report_dir, colorkey_fname), bbox_inches='tight', transparent = True, pad_inches=0)
 
     return colorkey_fname
 
 
+def _cache_key(fname, *args):
+    """
+    Volume cache key from absolute path, modification time and any extra arguments
+    """
+
+    fname = os.path.realpath(fname)
+
+    return (fname, os.path.getmtime(fname)) + args
+
+
+def cached_header(fname):
+    """
+    Load image header only (no voxel data) through the in-process volume cache
+
+    Parameters
+    ----------
+    fname: string
+        Nifti image filename
+
+    Returns
+    -------
+    hdr: Nifti header
+        image header with shape and zooms
+    """
+
+    key = _cache_key(fname, 'header')
+
+    if key not in _volume_cache:
+        _volume_cache[key] = nib.load(fname).header
+
+    return _volume_cache[key]
+
+
+def cached_background(bg_fname, bbox, yy, cache_dir):
+    """
+    Coronal sections of background image cropped to a bounding box and normalized to [0,1]
+    Cached across calls with the same background, bounding box and sections
+
+    Parameters
+    ----------
+    bg_fname: string
+        background image filename
+    bbox: tuple
+        x0, x1, y0, y1, z0, z1 crop limits
+    yy: numpy integer array
+        coronal section indices
+    cache_dir: string
+        directory for uncompressed image cache
+
+    Returns
+    -------
+    bg_crop: 3D numpy array
+        cropped, normalized background sections
+    """
+
+    key = _cache_key(bg_fname, 'background') + tuple(int(b) for b in bbox) + tuple(int(y) for y in yy)
+
+    if key not in _volume_cache:
+
+        # Normalize background intensity range to [0,1]
+        bg_max = volume_summary(bg_fname, cache_dir)['max']
+        _volume_cache[key] = read_sections(bg_fname, cache_dir, bbox, yy) / bg_max
+
+    return _volume_cache[key]
+
+
+def uncompressed_cache(fname, cache_dir):
+    """
+    Uncompressed copy of a gzipped Nifti image for fast partial reads through
+    the nibabel array proxy. Rebuilt when the source image is newer.
+
+    Parameters
+    ----------
+    fname: string
+        Nifti image filename
+    cache_dir: string
+        cache directory
+
+    Returns
+    -------
+    nii_fname: string
+        uncompressed Nifti filename (fname itself if not compressed)
+    """
+
+    if not fname.endswith('.gz'):
+        return fname
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    nii_fname = os.path.join(cache_dir, os.path.basename(fname)[:-3])
+
+    if not os.path.isfile(nii_fname) or os.path.getmtime(nii_fname) < os.path.getmtime(fname):
+
+        print('  Caching uncompressed %s' % os.path.basename(fname))
+
+        # Stream decompression through process-specific temporary file
+        tmp_fname = nii_fname + '.%d.tmp' % os.getpid()
+        with gzip.open(fname, 'rb') as f_in, open(tmp_fname, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 16 * 1024 * 1024)
+        os.replace(tmp_fname, nii_fname)
+
+    return nii_fname
+
+
+def read_sections(fname, cache_dir, bbox, yy):
+    """
+    Read cropped coronal sections of a 3D or 4D image through the array proxy
+    of the uncompressed cache, without loading the full volume
+
+    Parameters
+    ----------
+    fname: string
+        Nifti image filename
+    cache_dir: string
+        cache directory
+    bbox: tuple
+        x0, x1, y0, y1, z0, z1 crop limits
+    yy: numpy integer array
+        coronal section indices
+
+    Returns
+    -------
+    sections: numpy array
+        nx x n_sections x nz [x nt] cropped sections
+    """
+
+    nii = nib.load(uncompressed_cache(fname, cache_dir))
+
+    x0, x1, _, _, z0, z1 = bbox
+
+    return np.stack([np.asanyarray(nii.dataobj[x0:x1, int(y), z0:z1, ...]) for y in yy], axis=1)
+
+
+def volume_summary(fname, cache_dir, p_thresh=0.0, slab=8):
+    """
+    Maximum intensity and x, y, z projections of (summed volumes > p_thresh)
+    computed in a single streamed pass over coronal slabs
+    Summary is cached as JSON in the cache directory until the image changes
+
+    Parameters
+    ----------
+    fname: string
+        Nifti image filename
+    cache_dir: string
+        cache directory
+    p_thresh: float
+        threshold applied to sum over volumes
+    slab: int
+        coronal slab thickness for streaming
+
+    Returns
+    -------
+    summary: dictionary
+        'max', 'xproj', 'yproj', 'zproj'
+    """
+
+    key = _cache_key(fname, 'summary', float(p_thresh))
+
+    if key in _volume_cache:
+        return _volume_cache[key]
+
+    summary_fname = os.path.join(cache_dir, os.path.basename(fname).split('.')[0] + '_summary.json')
+
+    # Reuse summary from disk if built from this image and threshold
+    if os.path.isfile(summary_fname):
+        with open(summary_fname, 'r') as f:
+            summary = json.load(f)
+        if summary.get('source') == list(key):
+            _volume_cache[key] = summary
+            return summary
+
+    nii = nib.load(uncompressed_cache(fname, cache_dir))
+    nx, ny, nz = nii.shape[:3]
+
+    vmax = -np.inf
+    xproj = np.zeros(nx, dtype=bool)
+    yproj = np.zeros(ny, dtype=bool)
+    zproj = np.zeros(nz, dtype=bool)
+
+    for y0 in range(0, ny, slab):
+
+        block = np.asanyarray(nii.dataobj[:, y0:y0+slab, ...])
+        vmax = max(vmax, float(np.max(block)))
+
+        if block.ndim > 3:
+            block = np.sum(block, axis=3)
+        mask = block > p_thresh
+
+        xproj |= np.any(mask, axis=(1, 2))
+        yproj[y0:y0+slab] = np.any(mask, axis=(0, 2))
+        zproj |= np.any(mask, axis=(0, 1))
+
+    summary = {'source': list(key),
+               'max': vmax,
+               'xproj': xproj.tolist(),
+               'yproj': yproj.tolist(),
+               'zproj': zproj.tolist()}
+
+    tmp_fname = summary_fname + '.%d.tmp' % os.getpid()
+    with open(tmp_fname, 'w') as f:
+        json.dump(summary, f)
+    os.replace(tmp_fname, summary_fname)
+
+    _volume_cache[key] = summary
+
+    return summary
+
+
+def label_colors(n_labels, hsv, atlas_color=False):
+    """
+    Construct RGB overlay color matrix for all labels
+
+    Parameters
+    ----------
+    n_labels: int
+        number of prob labels
+    hsv: numpy array
+        n_labels x 3 HSV colors from ITK-SNAP label key
+    atlas_color: bool
+        use label key colors rather than rotating hues
+
+    Returns
+    -------
+    rgb_colors: numpy array
+        n_labels x 3 RGB colors
+    """
+
+    rgb_colors = np.zeros([n_labels, 3])
+
+    for lc in range(0, n_labels):
+
+        # Hue and saturation for label overlay
+        if atlas_color:
+            # Pull HSV from ITK-SNAP label key
+            hue, sat, val = hsv[lc, 0], hsv[lc, 1], hsv[lc,2]
+        else:
+            # Calculate rotating hue
+            hue = float(np.mod(lc * 3, n_labels)) / n_labels
+            sat, val = 1.0, 1.0
+
+        rgb_colors[lc, :] = colorsys.hsv_to_rgb(hue, sat, val)
+
+    return rgb_colors
+
+
 def label_rgb2hsv(label_key):
     """
     Extract label RGB colors and convert to HSV
@@ -573,13 +1063,22 @@ def label_rgb2hsv(label_key):
     return hsv
 
 
+def montage_sections(ny, n):
+    """
+    Evenly spaced coronal section indices used by coronal_montage
+    """
+
+    return np.linspace(0, ny-1, n).astype(int)
+
+
 def coronal_montage(img, n_rows=4, n_cols=4, flip_x=False, flip_y=True, flip_z=True):
     """
     Create a montage of all coronal (XZ) slices from a 3D image
+    - 4D images are montaged volume by volume into a 3D stack of montages
 
     Parameters
     ----------
-    img: 3D image to montage
+    img: 3D or 4D image to montage
     n_rows: number of montage rows
     n_cols: number of montage columns
     rot: CCW 90deg rotations to apply to each section
@@ -587,17 +1086,17 @@ def coronal_montage(img, n_rows=4, n_cols=4, flip_x=False, flip_y=True, flip_z=T
     Returns
     -------
 
-    cor_mont: coronal slice montage of img
+    cor_mont: coronal slice montage of img (with trailing volume axis for 4D img)
     """
 
     # Total number of sections to extract
     n = n_rows * n_cols
 
     # Source image dimensions
-    nx, ny, nz = img.shape
+    nx, ny, nz = img.shape[:3]
 
     # Coronal (XZ) sections
-    yy = np.linspace(0, ny-1, n).astype(int)
+    yy = montage_sections(ny, n)
     cors = img[:,yy,:]
 
     if flip_x:
@@ -607,11 +1106,15 @@ def coronal_montage(img, n_rows=4, n_cols=4, flip_x=False, flip_y=True, flip_z=T
     if flip_z:
         cors = np.flip(cors, axis=2)
 
-    # Permute image axes for montage2d: original y becomes new x
-    img = np.transpose(cors, (1,2,0))
+    # Permute image axes for montage: original y becomes section index
+    img = np.moveaxis(cors, (1, 2, 0), (0, 1, 2))
 
-    # Construct montage of coronal sections
-    cor_mont = montage2d(img, fill=0, grid_shape=(n_rows, n_cols))
+    # Construct montage of coronal sections by tiling sections row-major
+    # sections x h x w [x volumes] -> rows x h x cols x w [x volumes]
+    _, h, w = img.shape[:3]
+    tiles = img.reshape((n_rows, n_cols, h, w) + img.shape[3:])
+    tiles = np.swapaxes(tiles, 1, 2)
+    cor_mont = tiles.reshape((n_rows * h, n_cols * w) + img.shape[3:])
 
     return cor_mont
 
@@ -641,7 +1144,7 @@ def tint(image, hue=0.0, saturation=1.0, value=1.0):
 def composite(overlay_rgb, background_rgb):
     """
     Alpha composite RGB overlay on RGB background
-    - derive alpha from HSV value of overlay
+    - derive alpha from HSV value (maximum RGB component) of overlay
 
     Parameters
     ----------
@@ -653,11 +1156,9 @@ def composite(overlay_rgb, background_rgb):
 
     """
 
-    overlay_hsv = color.rgb2hsv(overlay_rgb)
-    value = overlay_hsv[:,:,2]
-    alpha_rgb = np.dstack((value, value, value))
+    alpha = np.max(overlay_rgb, axis=2)[:, :, np.newaxis]
 
-    composite_rgb = overlay_rgb * alpha_rgb + background_rgb * (1.0 - alpha_rgb)
+    composite_rgb = overlay_rgb * alpha + background_rgb * (1.0 - alpha)
 
     return composite_rgb
 
@@ -665,6 +1166,7 @@ def composite(overlay_rgb, background_rgb):
 def similarity_figure(metric, img_title, img_fname, report_dir, label_names, mlims, nrows, ncols, nansub=0.0, fontsize=8, strip_prefix=False):
     """
     Plot an array of similarity matrix figures for a given observer or template
+    - all label matrices are tiled into a single padded mosaic and drawn with one imshow
 
     Parameters
     ----------
@@ -691,38 +1193,49 @@ def similarity_figure(metric, img_title, img_fname, report_dir, label_names, mli
     -------
     """
 
-    # Create figure with subplot array
-    fig, axs = plt.subplots(nrows, ncols)
-    axs = np.array(axs).reshape(-1)
-
-    im = []
-
-    for aa, ax in enumerate(axs):
-
-        if aa < len(label_names):
-            mmaa = np.flipud(metric[aa, :, :]).copy()
-            mmaa[np.isnan(mmaa)] = nansub
-            im = ax.pcolor(mmaa, vmin=mlims[0], vmax=mlims[1], cmap='Spectral')
-            if strip_prefix:
-                label_name = do_strip_prefix(label_names[aa])
-            else:
-                label_name = label_names[aa]
-            ax.set_title(label_name, fontsize=fontsize)
-        else:
-            ax.axis('off')
-
-        ax.get_xaxis().set_visible(False)
-        ax.get_yaxis().set_visible(False)
-        ax.set(adjustable='box-forced', aspect='equal')
+    # Similarity matrix dimensions
+    n_labels, m = metric.shape[0], metric.shape[1]
+
+    # Tile padding: space above each matrix for its title, gap between columns
+    pad_y = max(1, int(np.ceil(m * 0.4)))
+    pad_x = max(1, int(np.ceil(m * 0.2)))
+    th, tw = m + pad_y, m + pad_x
+
+    # Substitute NaNs in label matrices. Padding and empty tiles stay NaN (blank)
+    tiles = np.full([nrows * ncols, th, tw], np.nan)
+    mm = np.array(metric[:nrows * ncols], dtype=float)
+    mm[np.isnan(mm)] = nansub
+    tiles[:n_labels, pad_y:, :m] = mm
+
+    # Row-major tiling into mosaic
+    mosaic = tiles.reshape(nrows, ncols, th, tw).swapaxes(1, 2).reshape(nrows * th, ncols * tw)
+
+    # Blank padding and empty tiles
+    cmap = copy.copy(plt.get_cmap('Spectral'))
+    cmap.set_bad(color='white', alpha=0.0)
+
+    # Single image for all labels
+    ax_w = 2.0 * ncols
+    fig, ax = plt.subplots(figsize=(ax_w + 1.5, ax_w * nrows * th / float(ncols * tw) + 1.0))
+    im = ax.imshow(mosaic, vmin=mlims[0], vmax=mlims[1], cmap=cmap,
+                   interpolation='nearest', origin='upper', aspect='equal')
+    ax.axis('off')
+
+    # Label titles centered above each tile
+    if strip_prefix:
+        titles = do_strip_prefixes(label_names[:n_labels])
+    else:
+        titles = label_names[:n_labels]
 
-    # Tidy up spacing
-    plt.tight_layout()
+    aa = np.arange(len(titles))
+    tx = (aa % ncols) * tw + (m - 1) / 2.0
+    ty = (aa // ncols) * th + pad_y - 1.0
+    for x, y, title in zip(tx, ty, titles):
+        ax.text(x, y, title, fontsize=fontsize, ha='center', va='bottom', clip_on=False)
 
-    # Make space for title and colorbar
-    fig.subplots_adjust(bottom=0.1, top=0.9, left=0.1, right=0.8)
-    plt.suptitle(img_title, x=0.5, y=0.99)
-    cax = fig.add_axes([0.85, 0.1, 0.05, 0.8])  # [x0, y0, w, h]
-    fig.colorbar(im, cax=cax)
+    # Title and colorbar
+    ax.set_title(img_title, pad=2.0 * fontsize)
+    fig.colorbar(im, ax=ax, fraction=0.05, pad=0.02)
 
     # Save figure to PNG
     print('  Saving image to %s' % img_fname)
@@ -748,14 +1261,33 @@ def bb(mask, padding=8):
     x0, x1, y0, y1, z0, z1: bounding box limits
     """
 
-    # Mask dimensions
-    nx, ny, nz = mask.shape
-
     # MIP in x, y, z
     xproj = np.max(np.max(mask, axis=2), axis=1)
     yproj = np.max(np.max(mask, axis=2), axis=0)
     zproj = np.max(np.max(mask, axis=1), axis=0)
 
+    return bb_projections(xproj, yproj, zproj, padding)
+
+
+def bb_projections(xproj, yproj, zproj, padding=8):
+    """
+    Determine minimum bounding box from x, y and z projections of a mask
+
+    Parameters
+    ----------
+    xproj, yproj, zproj: 1D boolean arrays
+        mask projections onto each axis
+    padding: integer
+        voxel padding around minimum BB
+
+    Returns
+    -------
+    x0, x1, y0, y1, z0, z1: bounding box limits
+    """
+
+    # Mask dimensions
+    nx, ny, nz = len(xproj), len(yproj), len(zproj)
+
     # Non-zero indices in each projection
     xnz = np.nonzero(xproj)[0]
     ynz = np.nonzero(yproj)[0]
@@ -779,7 +1311,9 @@ def bb(mask, padding=8):
 
 def load_metrics(atlas_dir):
     """
-    Parse similarity metrics from CSV file
+    Load similarity metrics from the atlas directory
+    - memory-map the columnar metrics store written by atlas.py if present
+    - otherwise parse the exported CSV files
 
     Parameters
     ----------
@@ -790,6 +1324,20 @@ def load_metrics(atlas_dir):
     m : numpy array containing label, observer and template indices and metrics
     """
 
+    metrics_npz = os.path.join(atlas_dir, 'similarity_metrics.npz')
+
+    if os.path.isfile(metrics_npz):
+
+        m = load_metrics_store(metrics_npz)
+
+        label_names, label_nos = m['label_names'], m['label_nos']
+        observers, templates = m['observers'], m['templates']
+
+        intra_metrics = label_names, label_nos, observers, templates, m['intra_dice'], m['intra_haus']
+        inter_metrics = label_names, label_nos, observers, templates, m['inter_dice'], m['inter_haus']
+
+        return intra_metrics, inter_metrics
+
     #
     # Load intra-observer metrics
     # Ignore number of voxels in each label (nA, nB) for now
@@ -39,7 +39,7 @@ Copyright
 
 from atlas_report import *
 
-atlas_dir = os.environ['ATLAS_DIR'] # directory containing e.g. inter_observer_metrics.csv
+atlas_dir = os.environ['ATLAS_DIR'] # directory containing similarity_metrics.npz or inter_observer_metrics.csv
 
 intra_stats, inter_stats = load_metrics(atlas_dir)
 report_dir = '/tmp/'
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+'''
+Benchmark contour rasterization and sample point generation in interp_labels_a3
+- Compares batched ReduceSlices2Contours and MakeSamplePoints against the
+  original per-point Python loops on a synthetic multi-slice label
+
+Usage
+----
+bench_interp_labels_a3.py [-n <volume size>] [-s <slice spacing>] [-r <repeats>]
+bench_interp_labels_a3.py -h
+
+Example
+----
+>>> bench_interp_labels_a3.py -n 128 -s 4
+
+Authors
+----
+Mike Tyszka and Wolfgang Pauli, Caltech
+
+Dates
+----
+2026-10-18 From scratch
+
+License
+----
+This file is part of atlaskit.
+
+    atlaskit is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    atlaskit is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with atlaskit.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright
+----
+2026 California Institute of Technology.
+'''
+
+__version__ = '0.1.0'
+
+import sys
+import time
+import argparse
+import numpy as np
+from skimage import measure
+
+import interp_labels_a3 as ila3
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Benchmark interp_labels_a3 preprocessing')
+    parser.add_argument('-n', '--size', type=int, default=96, help="Synthetic volume size [96]")
+    parser.add_argument('-s', '--spacing', type=int, default=4, help="Spacing of labeled slices [4]")
+    parser.add_argument('-r', '--repeats', type=int, default=3, help="Timing repeats [3]")
+
+    args = parser.parse_args()
+
+    # Construct synthetic sparsely labeled volume
+    L = SyntheticLabel(args.size, args.spacing)
+    slices = (np.where(L.sum(axis=(1, 2)) > 0),
+              np.where(L.sum(axis=(0, 2)) > 0),
+              np.where(L.sum(axis=(0, 1)) > 0))
+    dist = float(args.spacing)
+
+    print('Synthetic label : %d^3 voxels, %d labeled voxels' % (args.size, L.sum()))
+    print('Labeled slices  : x %d, y %d, z %d' % tuple(s[0].size for s in slices))
+
+    # Check batched implementations reproduce the loop implementations
+    c_loop, _ = ReduceSlices2ContoursLoop(L, slices)
+    c_fast, _ = ila3.ReduceSlices2Contours(L, slices)
+    s_loop = MakeSamplePointsLoop(L, slices, dist)
+    s_fast = ila3.MakeSamplePoints(L, slices, dist)
+
+    if not np.array_equal(c_loop, c_fast) or not np.array_equal(s_loop, s_fast):
+        print('* Batched and loop results differ - exiting')
+        sys.exit(1)
+
+    # Time each implementation
+    print('')
+    print('%-24s %10s %10s %8s' % ('Function', 'Loop (s)', 'Batch (s)', 'Speedup'))
+    Report('ReduceSlices2Contours',
+           Timeit(ReduceSlices2ContoursLoop, args.repeats, L, slices),
+           Timeit(ila3.ReduceSlices2Contours, args.repeats, L, slices))
+    Report('MakeSamplePoints',
+           Timeit(MakeSamplePointsLoop, args.repeats, L, slices, dist),
+           Timeit(ila3.MakeSamplePoints, args.repeats, L, slices, dist))
+
+    # Clean exit
+    sys.exit(0)
+
+
+def SyntheticLabel(n, spacing):
+    '''
+    Ellipsoid label retained only on every spacing-th slice in each axis
+    '''
+
+    x, y, z = np.meshgrid(*(np.linspace(-1, 1, n),) * 3, indexing='ij')
+    ellipsoid = (x / 0.8)**2 + (y / 0.6)**2 + (z / 0.7)**2 < 1.0
+
+    sparse = np.zeros(ellipsoid.shape, dtype=bool)
+    sparse[::spacing, :, :] |= ellipsoid[::spacing, :, :]
+    sparse[:, ::spacing, :] |= ellipsoid[:, ::spacing, :]
+    sparse[:, :, ::spacing] |= ellipsoid[:, :, ::spacing]
+
+    return sparse.astype(float)
+
+
+def Timeit(func, repeats, *args):
+    '''
+    Best wall time of repeated function calls
+    '''
+
+    best = np.inf
+    for r in range(repeats):
+        t0 = time.time()
+        func(*args)
+        best = min(best, time.time() - t0)
+
+    return best
+
+
+def Report(name, t_loop, t_fast):
+    print('%-24s %10.4f %10.4f %7.1fx' % (name, t_loop, t_fast, t_loop / max(t_fast, 1e-9)))
+
+
+def ReduceSlices2ContoursLoop(Lsub, slices):
+    '''
+    Original per-point contour rasterization
+    '''
+
+    new_Lsub = np.zeros_like(Lsub)
+    all_contours = []
+    for axis in range(3):
+        for i in slices[axis][0]:
+            if axis == 0:
+                myslice = Lsub[i,:,:]
+            elif axis == 1:
+                myslice = Lsub[:,i,:]
+            elif axis == 2:
+                myslice = Lsub[:,:,i]
+            contours = measure.find_contours(myslice, 0.5,fully_connected='high')
+            myslice = np.zeros_like(myslice)
+            for contour in contours:
+                all_contours.append(contour)
+                for p in range(len(contour)):
+                    x,y = contour[p]
+                    myslice[int(x), int(y)] = 1
+                if axis == 0:
+                    new_Lsub[i,:,:] += myslice
+                elif axis == 1:
+                    new_Lsub[:,i,:] += myslice
+                elif axis == 2:
+                    new_Lsub[:,:,i] += myslice
+    new_Lsub = (new_Lsub > 0.5).astype(int)
+    return(new_Lsub, all_contours)
+
+
+def MakeSamplePointsLoop(vol, slices, dist):
+    '''
+    Original nested loop sample point generation (integer dist only)
+    '''
+
+    vol_s = np.zeros_like(vol)
+    for axis in range(3):
+        for i in slices[axis][0]:
+            if axis == 0:
+                myslice = vol[i,:,:]
+            elif axis == 1:
+                myslice = vol[:,i,:]
+            elif axis == 2:
+                myslice = vol[:,:,i]
+            xs = np.arange(0, myslice.shape[0], int(dist))
+            ys = np.arange(0, myslice.shape[1], int(dist))
+            myslice_s = np.zeros_like(myslice)
+            for x in xs:
+                for y in ys:
+                    myslice_s[x,y] = 1
+            myslice_s = (myslice + myslice_s) > 1
+            if axis == 0:
+                vol_s[i,:,:] = myslice_s
+            elif axis == 1:
+                vol_s[:,i,:] = myslice_s
+            elif axis == 2:
+                vol_s[:,:,i] = myslice_s
+    return(vol_s)
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,7 @@ interp_labels.py -h
 Example
 ----
 >>> interp_labels.py -i labels.nii.gz -l 1,3,4
+>>> interp_labels.py -i labels.nii.gz -l 1,3,4 -m sdf -c
 
 Authors
 ----
@@ -54,6 +55,7 @@ from scipy.interpolate import Rbf
 from scipy.signal import medfilt
 from scipy.ndimage.morphology import distance_transform_edt as EDT
 from scipy.ndimage.morphology import binary_erosion, binary_dilation
+from scipy.ndimage.filters import gaussian_filter
 
 
 def main():
@@ -62,6 +64,12 @@ def main():
     parser = argparse.ArgumentParser(description='Interpolate labels')
     parser.add_argument('-i','--input', required=True, help="Labeled volume")
     parser.add_argument('-l','--labels', help="Label numbers to interpolate, separated by comma")
+    parser.add_argument('-m','--method', choices=['rbf','sdf'], default='rbf',
+                        help="Interpolation method: global RBF or shape-based signed distance [rbf]")
+    parser.add_argument('-c','--combine', default=False, action='store_true',
+                        help="sdf method: combine all slice axes rather than the best sampled axis")
+    parser.add_argument('-n','--max-nodes', type=int, default=None,
+                        help="rbf method: target number of RBF nodes per label [one third of boundary voxels]")
 
     # Parse command line arguments
     args = parser.parse_args()
@@ -126,12 +134,20 @@ def main():
             # Only interpolate if slice-like features found
             if nSx > 1 or nSy > 1 or nSz > 1:
             
-                # Construct point value lists over all slices
-                nodes, vals = NodeValues(Lsub, slices)
-                
-                # RBF Interpolate values within subvolume
-                # Returns thresholded integer volume
-                Lsubi = RBFInterpolate(Lsub, nodes, vals)
+                if args.method == 'sdf':
+
+                    # Shape-based interpolation of slice signed distance maps
+                    # Returns thresholded integer volume
+                    Lsubi = SDFInterpolate(Lsub, slices, combine=args.combine)
+
+                else:
+
+                    # Construct point value lists over all slices
+                    nodes, vals = NodeValues(Lsub, slices, max_nodes=args.max_nodes)
+
+                    # RBF Interpolate values within subvolume
+                    # Returns thresholded integer volume
+                    Lsubi = RBFInterpolate(Lsub, nodes, vals)
                 
                 # Scale interpolation back to original label value
                 Lsubi *= label
@@ -228,10 +244,11 @@ def FindSlices(label):
     return Sx, Sy, Sz
     
     
-def NodeValues(vol, slices):
+def NodeValues(vol, slices, max_nodes=None):
     '''
     Generate coordinate nodes and values for interpolation
     Extract values from x, y and z slices in volume
+    Optional max_nodes sets the target node budget over all slices
     '''
     
     # Init coordinate and value arrays
@@ -240,6 +257,18 @@ def NodeValues(vol, slices):
 
     # X, Y and Z slice lists
     Sx, Sy, Sz = slices
+
+    # Every third point(ish) on boundary should be sufficient for accurate RBF
+    frac = 1.0 / 3.0
+
+    # Spread node budget over slices in proportion to boundary length
+    if max_nodes:
+        n_bound = 0
+        for a in range(3):
+            for i in slices[a][0]:
+                n_bound += _boundary_layer(np.take(vol, i, axis=a)).sum()
+        if n_bound > 0:
+            frac = min(frac, max_nodes / float(n_bound))
     
     for x in Sx[0]:
         
@@ -247,7 +276,7 @@ def NodeValues(vol, slices):
         v_yz = vol[x,:,:].squeeze()
         
         # Inside-outside values and nodes from slice
-        io_yz, yz = InsideOutside(v_yz)
+        io_yz, yz = InsideOutside(v_yz, frac)
 
         # Construct 3D coordinate list
         n = yz.shape[0]
@@ -266,7 +295,7 @@ def NodeValues(vol, slices):
         v_xz = vol[:,y,:].squeeze()
         
         # Inside-outside values and nodes from slice
-        io_xz, xz = InsideOutside(v_xz)
+        io_xz, xz = InsideOutside(v_xz, frac)
         
         # Construct 3D coordinate list
         n = xz.shape[0]
@@ -285,7 +314,7 @@ def NodeValues(vol, slices):
         v_xy = vol[:,:,z].squeeze()
         
         # Inside-outside values and nodes from slice
-        io_xy, xy = InsideOutside(v_xy)
+        io_xy, xy = InsideOutside(v_xy, frac)
         
         # Construct 3D coordinate list
         n = xy.shape[0]
@@ -309,7 +338,7 @@ def NodeValues(vol, slices):
     return nodes, vals
 
 
-def InsideOutside(s):
+def InsideOutside(s, frac=1.0/3.0):
     '''
     Create inside-outside function for slice and extract nodes, values
     just inside, just outside and on the boundary
@@ -318,34 +347,185 @@ def InsideOutside(s):
     ----
     s : 2D numpy integer array
         Extracted slice of label volume
+    frac : float
+        Fraction of boundary layer voxels to retain as nodes
     '''
     
-    nx, ny = s.shape
-
-    # Create boundary layer mask from difference between dilation
-    # and erosion of label. The mask represents the layers of
-    # voxels immediately inside and outside the boundary.
-    bound_mask = binary_dilation(s) - binary_erosion(s)
+    # Boundary layer mask
+    bound_mask = _boundary_layer(s)
     
     # Inside-outside function from complement Euclidian distance transforms
-    # Positive outside, negative inside
-    io = EDT(1-s) - EDT(s)
+    io = SignedDistance(s)
     
     # Extract x, y coordinates and IO function values boundary layers
     xy = np.argwhere(bound_mask) # N x 2 coordinates of non-zero voxels
-    
-    # Random downsample by 3
-    # Every third point(ish) on boundary should be sufficient for accurate RBF
+    io_xy = io[xy[:,0], xy[:,1]]
+
+    # Contour curvature from the smoothed inside-outside function
+    kappa = Curvature(io)[xy[:,0], xy[:,1]]
+
+    # Deterministic curvature-adaptive downsampling of inside and outside layers
+    keep = []
+    for layer in (np.where(io_xy < 0)[0], np.where(io_xy > 0)[0]):
+        n_keep = int(round(layer.size * frac))
+        samp = AdaptiveNodes(xy[layer,:], kappa[layer], n_keep)
+        keep.append(layer[samp])
+    keep = np.sort(np.concatenate(keep))
+
+    return io_xy[keep], xy[keep,:]
+
+
+def AdaptiveNodes(xy, kappa, n_keep, gain=4.0):
+    '''
+    Select n_keep boundary nodes, dense where the contour bends and sparse
+    along straight runs, by curvature-weighted farthest point sampling
+    Selection is deterministic for a given slice
+
+    Arguments
+    ----
+    xy : N x 2 numpy array
+        Boundary voxel coordinates
+    kappa : N numpy array
+        Contour curvature at each boundary voxel
+    n_keep : int
+        Target number of nodes
+    gain : float
+        Node density gain per unit curvature
+    '''
+
     n = xy.shape[0]
-    samp = np.random.choice(np.arange(n), int(n/3.0))
-    xy = xy[samp,:]
-    
-    io_xy = io[xy[:,0], xy[:,1]] 
-    
-    return io_xy, xy
+    if n_keep >= n:
+        return np.arange(n)
+    if n_keep < 1:
+        return np.array([], dtype=int)
+
+    # Weighted distances favour high curvature voxels
+    w = 1.0 + gain * np.abs(kappa)
+
+    # Seed with the highest curvature voxel
+    samp = np.zeros(n_keep, dtype=int)
+    samp[0] = np.argmax(w)
+    d = np.full(n, np.inf)
+
+    for k in range(1, n_keep):
+        d = np.minimum(d, np.hypot(*(xy - xy[samp[k-1]]).T))
+        samp[k] = np.argmax(d * w)
+
+    return samp
+
+
+def Curvature(io, sigma=1.0):
+    '''
+    Curvature of inside-outside function level sets
+    Divergence of the unit normal of the smoothed signed distance map
+    '''
+
+    io = gaussian_filter(io.astype(float), sigma)
+
+    gx, gy = np.gradient(io)
+    g = np.hypot(gx, gy) + 1e-6
+
+    return np.gradient(gx / g, axis=0) + np.gradient(gy / g, axis=1)
+
+
+def _boundary_layer(s):
+    '''
+    Boundary layer mask from difference between dilation and erosion of label
+    The mask represents the layers of voxels immediately inside and outside
+    the boundary.
+    '''
+
+    s = s > 0
+
+    return binary_dilation(s) ^ binary_erosion(s)
     
     
 
+def SignedDistance(s):
+    '''
+    Signed Euclidean distance map of a 2D label slice
+    Positive outside, negative inside
+
+    Arguments
+    ----
+    s : 2D numpy integer array
+        Extracted slice of label volume
+    '''
+
+    s = s > 0
+
+    # Empty slice - everything is outside by at least the slice diagonal
+    if not s.any():
+        return np.full(s.shape, np.hypot(*s.shape))
+
+    return EDT(~s) - EDT(s)
+
+
+def SDFInterpolate(vol, slices, combine=False):
+    '''
+    Shape-based interpolation between labeled slices
+    Linearly interpolate slice signed distance maps along each slice axis
+    and threshold at zero
+
+    Arguments
+    ----
+    vol : 3D numpy array
+        Label subvolume
+    slices : 3-tuple
+        Labeled slice locations in each axis from FindSlices
+    combine : bool
+        Average signed distances over all axes with at least two slices,
+        otherwise use the axis with the most labeled slices
+        Each position averages only the axes whose labeled slice range covers it
+    '''
+
+    # Axes with at least one interval between labeled slices
+    axes = [a for a in range(3) if slices[a][0].size > 1]
+
+    if not combine:
+        axes = [max(axes, key=lambda a: slices[a][0].size)]
+
+    print('  Interpolating signed distance along axes : %s' % ','.join('xyz'[a] for a in axes))
+
+    # Sum and count of signed distances over axes covering each position
+    sdf = np.zeros(vol.shape, dtype=np.float32)
+    n_axes = np.zeros(vol.shape, dtype=np.uint8)
+    for a in axes:
+        sdf_a = AxisSDF(vol, slices[a][0], a)
+        covered = ~np.isnan(sdf_a)
+        sdf[covered] += sdf_a[covered]
+        n_axes += covered
+
+    # Signed distance is zero on boundary, negative inside label
+    # Positions outside every axis range are outside the label
+    voli = ((sdf < 0.0) & (n_axes > 0)).astype(int)
+
+    return voli
+
+
+def AxisSDF(vol, s, axis):
+    '''
+    Signed distance volume interpolated between labeled slices along one axis
+    Positions outside the labeled slice range are NaN (no estimate from this axis)
+    '''
+
+    s = np.sort(s)
+
+    # Signed distance map for each labeled slice
+    sdf_s = np.stack([SignedDistance(np.take(vol, i, axis=axis)) for i in s]).astype(np.float32)
+
+    # Bracketing labeled slices and linear weight for every position in range
+    p = np.arange(s[0], s[-1] + 1)
+    j = np.clip(np.searchsorted(s, p, side='right') - 1, 0, s.size - 2)
+    w = ((p - s[j]) / (s[j+1] - s[j]).astype(float)).astype(np.float32)[:, np.newaxis, np.newaxis]
+
+    # Position axis first, then restore original axis order
+    sdf = np.full(np.moveaxis(vol, axis, 0).shape, np.nan, dtype=np.float32)
+    sdf[p] = (1.0 - w) * sdf_s[j] + w * sdf_s[j+1]
+
+    return np.moveaxis(sdf, 0, axis)
+
+
 def RBFInterpolate(vol, nodes, vals, function='multiquadric', smooth=0.5):
     '''
     Interpolate node values within the volume using a radial basis function
@@ -399,8 +579,12 @@ def _unique_rows(a):
     diff = np.diff(a, axis=0)
     ui = np.ones(len(a), 'bool')
     ui[1:] = (diff != 0).any(axis=1)
+
+    # Map mask from sorted order back to original row order
+    mask = np.zeros(len(a), 'bool')
+    mask[order] = ui
     
-    return ui
+    return mask
     
 
 # This is the standard boilerplate that calls the main() function.
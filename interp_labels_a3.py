@@ -11,6 +11,7 @@ interp_labels.py -h
 Example
 ----
 >>> interp_labels_a3.py -i labels.nii.gz -l 1,3,4
+>>> interp_labels_a3.py -i labels.nii.gz -j 8
 
 Authors
 ----
@@ -55,6 +56,8 @@ from scipy.signal import medfilt
 from scipy.spatial import Delaunay
 from skimage import measure
 import time
+import multiprocessing as mp
+from scipy.ndimage import find_objects
 from scipy.ndimage.filters import gaussian_filter
 
 
@@ -69,30 +72,26 @@ def ReduceSlices2Contours(Lsub, slices):
     @return: Volume with Labels reduced to contours in same format as input, list of all detected contorus w/ x,y of points in each contour
     @rtype: list
     """
-    new_Lsub = np.zeros_like(Lsub)
     all_contours = []
+    all_points = []
     for axis in range(3):
         for i in slices[axis][0]:
-            if axis == 0:
-                myslice = Lsub[i,:,:]
-            elif axis == 1:
-                myslice = Lsub[:,i,:]
-            elif axis == 2:
-                myslice = Lsub[:,:,i]
+            myslice = np.take(Lsub, i, axis=axis)
             contours = measure.find_contours(myslice, 0.5,fully_connected='high')
-            myslice = np.zeros_like(myslice)
-            for contour in contours:
-                all_contours.append(contour)
-                for p in range(len(contour)):
-                    x,y = contour[p]
-                    myslice[int(x), int(y)] = 1
-                if axis == 0:
-                    new_Lsub[i,:,:] += myslice
-                elif axis == 1:
-                    new_Lsub[:,i,:] += myslice
-                elif axis == 2:
-                    new_Lsub[:,:,i] += myslice
-    new_Lsub = (new_Lsub > 0.5).astype(int)
+            if not contours:
+                continue
+            all_contours.extend(contours)
+
+            # Stack all contour points in this slice and insert slice coordinate
+            pts = np.vstack(contours).astype(int)
+            all_points.append(np.insert(pts, axis, i, axis=1))
+
+    # Scatter all contour points into the volume in one pass
+    new_Lsub = np.zeros(Lsub.shape, dtype=int)
+    if all_points:
+        pts = np.vstack(all_points)
+        new_Lsub[pts[:,0], pts[:,1], pts[:,2]] = 1
+
     return(new_Lsub, all_contours)
 
 
@@ -132,29 +131,45 @@ def MakeSamplePoints(vol, slices, dist):
     """
     vol_s = np.zeros_like(vol)
     for axis in range(3):
-        for i in slices[axis][0]:
-            if axis == 0:
-                myslice = vol[i,:,:]
-            elif axis == 1:
-                myslice = vol[:,i,:]
-            elif axis == 2:
-                myslice = vol[:,:,i]
-            xs = np.arange(0, myslice.shape[0], dist)
-            ys = np.arange(0, myslice.shape[1], dist)
-            myslice_s = np.zeros_like(myslice)
-            for x in xs:
-                for y in ys: 
-                    myslice_s[x,y] = 1
-            myslice_s = (myslice + myslice_s) > 1
-            if axis == 0:
-                vol_s[i,:,:] = myslice_s
-            elif axis == 1:
-                vol_s[:,i,:] = myslice_s
-            elif axis == 2:
-                vol_s[:,:,i] = myslice_s
+        s = slices[axis][0]
+        if len(s) < 1:
+            continue
+
+        # Sample lattice is identical for all slices along this axis
+        in_plane = [n for a, n in enumerate(vol.shape) if a != axis]
+        lattice = _SampleLattice(in_plane, dist)
+
+        # Mask all slices along this axis with the lattice in one operation
+        idx = [slice(None)] * 3
+        idx[axis] = s
+        idx = tuple(idx)
+        vol_s[idx] = np.logical_and(vol[idx] > 0, np.expand_dims(lattice, axis))
     return(vol_s)
 
 
+def _SampleLattice(shape, dist):
+    """
+    Regular 2D lattice of sample points with spacing dist
+    
+    @param shape: in-plane slice dimensions
+    @type shape: 2-list
+    @param dist: lattice spacing in voxels
+    @type dist: float
+    @return: boolean lattice mask
+    @rtype: 2D np.array
+    """
+    lattice = np.zeros(shape, dtype=bool)
+    if float(dist).is_integer():
+        d = int(dist)
+        lattice[::d, ::d] = True
+    else:
+        # Non-integer spacing (eg median of even number of gaps) - truncate sample coordinates
+        xs = np.arange(0, shape[0], dist).astype(int)
+        ys = np.arange(0, shape[1], dist).astype(int)
+        lattice[np.ix_(xs, ys)] = True
+    return(lattice)
+
+
 def ExtractMinVol(label):
     '''
     Extract minimum subvolume containing label voxels
@@ -172,6 +187,33 @@ def ExtractMinVol(label):
     
     return subvol, bb
 
+
+def ExtractMinVols(labels, label_nos):
+    '''
+    Extract minimum subvolumes for several labels from a single pass
+    over the label volume
+    Returns dictionary of (binary subvolume, bounding box) keyed by label number
+    '''
+
+    # Integer labels are used as they are - only float-stored labels are converted
+    if not np.issubdtype(labels.dtype, np.integer):
+        labels = np.rint(labels).astype(np.int32)
+
+    # Bounding slices of every label up to the largest requested
+    objs = find_objects(labels, max_label=max(label_nos))
+
+    subvols = {}
+    for label in label_nos:
+
+        sl = objs[label-1]
+        if sl is None:
+            continue
+
+        bb = sl[0].start, sl[0].stop, sl[1].start, sl[1].stop, sl[2].start, sl[2].stop
+        subvols[label] = ((labels[sl] == label).astype(float), bb)
+
+    return subvols
+
  
 def InsertSubVol(label, new_subvol, bb):
     '''
@@ -380,13 +422,13 @@ def _unique_rows(a):
 
 
 def alpha_shape(points, tri, alpha):
-    classification = np.zeros(tri.vertices.shape[0])
+    classification = np.zeros(tri.simplices.shape[0])
 
-    for i in range(tri.vertices.shape[0]):
-        pa = points[tri.vertices[i,0]]
-        pb = points[tri.vertices[i,1]]
-        pc = points[tri.vertices[i,2]]
-        pd = points[tri.vertices[i,3]]
+    for i in range(tri.simplices.shape[0]):
+        pa = points[tri.simplices[i,0]]
+        pb = points[tri.simplices[i,1]]
+        pc = points[tri.simplices[i,2]]
+        pd = points[tri.simplices[i,3]]
 
         # a = |x_1 y_1 z_1 1; x_2 y_2 z_2 1; x_3 y_3 z_3 1; x_4 y_4 z_4 1|
         a = np.linalg.det(np.array([
@@ -426,11 +468,11 @@ def alpha_shape(points, tri, alpha):
     return(classification)
 
 
-def save_to_nifti(vol, bb, hdr_nii, out_fname):
+def save_to_nifti(vol, hdr_nii, out_fname):
     """
     Save vol to nifti-file
     
-    @param vol: volume to save 
+    @param vol: full label volume to save
     @type vol: 3d np.array
     @param hdr_nii: nifti object with relevant header info
     @type hdr_nii: nibabel nifti object
@@ -439,10 +481,7 @@ def save_to_nifti(vol, bb, hdr_nii, out_fname):
     @return: ''
     @rtype: None
     """
-    # Save interpolated label volume
-    tmp_vol = hdr_nii.get_data().copy()
-    tmp_vol = InsertSubVol(tmp_vol, vol, bb)
-    out_nii = nib.Nifti1Image(tmp_vol, hdr_nii.get_affine())
+    out_nii = nib.Nifti1Image(vol, hdr_nii.affine)
     out_nii.to_filename(out_fname)
 
 
@@ -459,10 +498,7 @@ def SetValsPoints(points, vals, Lsub):
     @return: 3D np.array with vals at points
     @rtype: np.array
     """
-    #print new_labels.shape
-    for i in range(len(vals)):
-        point = points[i,:]
-        Lsub[point[0], point[1], point[2]] = vals[i]
+    Lsub[points[:,0], points[:,1], points[:,2]] = vals
 
 
 def smooth_labels(vol):
@@ -486,16 +522,105 @@ def smooth_labels(vol):
     vol = vol > 0.5
 
 
+def InterpolateLabel(Lsub, label, n_slices, save_delaunay=False, smooth=False):
+    """
+    Alpha shape interpolation of a single label subvolume
+    
+    @param Lsub: binary label subvolume from ExtractMinVol
+    @type Lsub: 3D np.array
+    @param label: label number written into interpolated voxels
+    @type label: int
+    @param n_slices: expected number of slices in each axis (0 = auto)
+    @type n_slices: list
+    @param save_delaunay: also return Delaunay simplex index volume
+    @type save_delaunay: bool
+    @param smooth: smooth results of interpolation
+    @type smooth: bool
+    @return: interpolated, preprocessed and Delaunay subvolumes (Delaunay is None unless requested)
+    @rtype: tuple
+    """
+    print('Interpolating label %d' % label)
+
+    # Detect slices in segmentaion image
+    slices = FindSlices(Lsub, n_slices)
+    print("  Label %d slices, x: %s, y: %s, z: %s" % (label, slices[0][0].shape[0],slices[1][0].shape[0],slices[2][0].shape[0]))
+
+    # Reduce to segmentation within slices to contour lines to speed up processing
+    Lsub_contour, contour = ReduceSlices2Contours(Lsub, slices)
+
+    # Calc median distance of slices
+    dist = EvalSliceDistance(slices)
+
+    # Set alpha so that it tetrahedrons between slices are not removed by alpha shape approach
+    alpha = 1.0/dist/2
+
+    # Fill contours with sample points for Delaunay tesselation
+    Lsub_sub = MakeSamplePoints(Lsub, slices, dist)
+
+    # Input to alpha shapes is the combination of contours and sample points
+    Lsub = Lsub_contour + Lsub_sub
+    Lsub = (Lsub > 0.5).astype(int)
+    Lsub_preproc = Lsub * label
+
+    print('  Label %d contains %d voxels' % (label, np.sum(Lsub[:])))
+
+    # get coordinates of segmentation labels
+    x,y,z = np.where(Lsub > 0)
+    points = np.transpose(np.array((x,y,z)))
+    
+    # perform Delaunay tesselation
+    tri = Delaunay(points)
+
+    # Construct interpolation mesh for volume
+    nx, ny, nz = Lsub.shape
+    xv, yv, zv = np.arange(0,nx), np.arange(0,ny), np.arange(0,nz)
+    xi, yi, zi = np.meshgrid(xv, yv, zv, indexing='ij')
+    new_points = np.column_stack([xi.ravel(), yi.ravel(), zi.ravel()])
+
+    # determine for each point in which tetrahedron it is
+    simplices_i = tri.find_simplex(new_points)
+
+    Lsub_delaunay = None
+    if save_delaunay:
+        vals = simplices_i.copy()
+        vals[vals == -1] = 0.0
+        Lsub_delaunay = Lsub.copy()
+        SetValsPoints(new_points, vals, Lsub_delaunay)
+
+    # perform alpha shape 3 
+    print("  Label %d vertices in Delaunay tesselation: %s" % (label, tri.simplices.shape[0]))
+    v_class = alpha_shape(points, tri, alpha)
+    print("  Label %d vertices in Alpha Complex: %s" % (label, np.sum(v_class)))
+
+    # Drop points in simplices outside the alpha complex
+    inside = simplices_i > -1
+    print("  Label %d points contained in Dalauny tesselation: %s" % (label, np.sum(inside)))
+    inside[inside] = v_class[simplices_i[inside]] > 0
+    print("  Label %d points contained in alpha complex: %s" % (label, np.sum(inside)))
+
+    # create segmentation image of interpolation
+    vals = np.zeros_like(simplices_i)
+    vals[inside] = label
+    SetValsPoints(new_points, vals, Lsub)
+
+    # smooth labels
+    if smooth:
+        smooth_labels(Lsub)
+
+    return Lsub, Lsub_preproc, Lsub_delaunay
+
+
 def main():
 
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Interpolate labels')
     parser.add_argument('-i','--input', required=True, help="Labeled volume")
-    parser.add_argument('-l','--labels', help="Label numbers to interpolate, separated by comma")
+    parser.add_argument('-l','--labels', help="Label numbers to interpolate, separated by comma [all labels]")
     parser.add_argument('-p', '--save-preproc', help="Save result of preprocessing", default=False, action='store_const', const=True, dest='save_preproc')
     parser.add_argument('-d', '--save-delaunay', help="Save result of Delaunay tesselation", default=False, action='store_const', const=True, dest='save_delaunay')
     parser.add_argument('-s', '--smooth-results', help="Smooth results of interpolation", default=False, action='store_const', const=True, dest='smooth_labels')
     parser.add_argument('-sl','--slices', help="Label numbers to interpolate, separated by comma")
+    parser.add_argument('-j','--jobs', type=int, default=1, help="Number of labels to interpolate in parallel [1]")
 
     # Parse command line arguments
     args = parser.parse_args()
@@ -504,6 +629,15 @@ def main():
     label_fname = args.input
     print(label_fname)
 
+    # Construct output filename    
+    out_stub, out_ext = os.path.splitext(label_fname)
+    if out_ext == '.gz':
+        out_stub, _ = os.path.splitext(out_stub)
+
+    # Load labeled volume once, keeping on-disk integer type
+    label_nii = nib.load(label_fname)
+    labels = np.asarray(label_nii.dataobj)
+
     if args.labels:
         sink = args.labels
         sink = sink.split(',')
@@ -512,7 +646,7 @@ def main():
             label_nos.append(int(sink[i]))
     else:
         # Construct list of unique label values in image
-        label_nos = np.unique(args.labels)
+        label_nos = [int(l) for l in np.unique(labels) if l > 0]
 
     if args.slices:
         sink = args.slices
@@ -524,113 +658,52 @@ def main():
         # Construct list of unique label values in image
         n_slices = [0,0,0]
 
-    # loop over each unique label value
-    for label in label_nos:
-        
-        if label > 0:
-            
-            print('Interpolating label %d' % label)
-
-    # Construct output filename    
-    out_stub, out_ext = os.path.splitext(label_fname)
-    if out_ext == '.gz':
-        out_stub, _ = os.path.splitext(out_stub)
-    
-    # Load labeled volume
-    label_nii = nib.load(label_fname)
-    labels = label_nii.get_data()
-
-    # Size of image space
-    nx, ny, nz = labels.shape
-
     # Remember when we started processing input
     start_time = time.time()
 
-    # Extract current label
-    L = (labels == label).astype(float)
+    # Minimum subvolume for each label from a single pass over the label volume
+    label_nos = [label for label in label_nos if label > 0]
+    subvols = ExtractMinVols(labels, label_nos)
 
-    # Extract minimum subvolume containing label
-    Lsub, bb = ExtractMinVol(L)
-
-    # Detect slices in segmentaion image
-    slices = FindSlices(Lsub, n_slices)
-    print("Number of slices, x: %s, y: %s, z: %s" % (slices[0][0].shape[0],slices[1][0].shape[0],slices[2][0].shape[0]))
-
-    # Reduce to segmentation within slices to contour lines to speed up processing
-    Lsub_contour, contour = ReduceSlices2Contours(Lsub, slices)
+    for label in label_nos:
+        if label not in subvols:
+            print('* Label %d not found in %s - skipping' % (label, label_fname))
+    label_nos = [label for label in label_nos if label in subvols]
 
-    # Calc median distance of slices
-    dist = EvalSliceDistance(slices)
+    # Tesselate each label independently
+    data_list = []
+    for label in label_nos:
+        data_list.append((subvols[label][0], label, n_slices, args.save_delaunay, args.smooth_labels))
 
-    # Set alpha so that it tetrahedrons between slices are not removed by alpha shape approach
-    alpha = 1.0/dist/2
+    if args.jobs > 1:
+        with mp.Pool(args.jobs) as pool:
+            res = pool.starmap(InterpolateLabel, data_list)
+    else:
+        res = [InterpolateLabel(*data) for data in data_list]
 
-    # Fill contours with sample points for Delaunay tesselation
-    Lsub_sub = MakeSamplePoints(Lsub, slices, dist)
+    # Combine all interpolated labels into output volumes
+    new_labels = labels.copy()
+    preproc = labels.copy() if args.save_preproc else None
+    delaunay = labels.copy() if args.save_delaunay else None
 
-    # Input to alpha shapes is the combination of contours and sample points
-    Lsub = Lsub_contour + Lsub_sub
-    Lsub = (Lsub > 0.5).astype(int)
+    for label, (Lsub_interp, Lsub_preproc, Lsub_delaunay) in zip(label_nos, res):
+        bb = subvols[label][1]
+        InsertSubVol(new_labels, Lsub_interp, bb)
+        if args.save_preproc:
+            InsertSubVol(preproc, Lsub_preproc, bb)
+        if args.save_delaunay:
+            InsertSubVol(delaunay, Lsub_delaunay, bb)
 
     if args.save_preproc:
         print('Saving result of preprocessing to %s' % (out_stub + '_preproc.nii.gz'))
-        save_to_nifti(Lsub, bb, label_nii, out_stub + '_preproc.nii.gz')
-
-    print('  Label contains %d voxels' % np.sum(Lsub[:]))
-
-    # get coordinates of segmentation labels
-    x,y,z = np.where(Lsub > 0)
-    points = np.transpose(np.array((x,y,z)))
-    
-    # perform Delaunay tesselation
-    tri = Delaunay(points)
-
-    # Construct interpolation mesh for volume
-    nx, ny, nz = Lsub.shape
-    xv, yv, zv = np.arange(0,nx), np.arange(0,ny), np.arange(0,nz)
-    xi, yi, zi = np.meshgrid(xv, yv, zv, indexing='ij')
-    xi, yi, zi = xi.reshape(-1,1), yi.reshape(-1,1), zi.reshape(-1,1)
-    
-    new_points = np.zeros((xi.shape[0], 3))
-    for i in range(xi.shape[0]):
-        new_points[i,:] = xi[i], yi[i], zi[i]
-
-    # determine for each point in which tetrahedron it is
-    simplices_i = tri.find_simplex(new_points)
+        save_to_nifti(preproc, label_nii, out_stub + '_preproc.nii.gz')
 
     if args.save_delaunay:
-        vals = simplices_i.copy()
-        vals[vals == -1] = 0.0
-        Lsub_tmp = Lsub.copy()
-        SetValsPoints(new_points, vals, Lsub_tmp)
         print('Saving result of Delaunay tesselation to %s' % (out_stub + '_delaunay.nii.gz'))
-        save_to_nifti(Lsub_tmp, bb, label_nii, out_stub + '_delaunay.nii.gz')
-
-
-    # perform alpha shape 3 
-    print("Vertices in Delaunay tesselation: %s" % tri.vertices.shape[0])
-    v_class = alpha_shape(points, tri, alpha)
-    print("Vertices in Alpha Complex: %s" % np.sum(v_class))
-
-
-    print("Points contained in Dalauny tesselation: %s" % len(np.where(simplices_i > -1)[0]))
-    for i in range(len(simplices_i)):
-        if simplices_i[i] > -1:
-            if v_class[simplices_i[i]] == 0:
-                simplices_i[i] = -1
-    print("Points contained in alpha complex: %s" % len(np.where(simplices_i > -1)[0]))
-
-    # create segmentation image of interpolation
-    vals = np.zeros_like(simplices_i)
-    vals[simplices_i > -1] = label
-    SetValsPoints(new_points, vals, Lsub)
-
-    # smooth labels
-    if args.smooth_labels:
-        smooth_labels(Lsub)
+        save_to_nifti(delaunay, label_nii, out_stub + '_delaunay.nii.gz')
 
     print('Saving result of interpolation to %s' % (out_stub + '_interp.nii.gz'))
-    save_to_nifti(Lsub, bb, label_nii, out_stub + '_interp.nii.gz')
+    save_to_nifti(new_labels, label_nii, out_stub + '_interp.nii.gz')
 
     print('Total Processing Time: %s s' % (time.time() - start_time))
 
@@ -2,6 +2,7 @@
 """
 Output volumes of each label in an atlas in microliters.
 - largely superseded by ITK-SNAP volume output
+- see volumetrics.py for many files and CSV output
 
 Usage
 ----
@@ -19,6 +20,7 @@ Mike Tyszka, Caltech Brain Imaging Center
 Dates
 ----
 2015-05-01 JMT From scratch
+2026-10-18 Count all labels with one np.bincount (volumetrics.py)
 
 License
 ----
@@ -46,8 +48,7 @@ __version__ = '0.1.0'
 
 import sys
 import argparse
-import nibabel as nib
-import numpy as np
+from volumetrics import file_volumes
 
 
 def main():
@@ -60,34 +61,15 @@ def main():
 
     atlas_file = args.atlas_file
         
-    # Load the source atlas image
-    atlas_nii = nib.load(atlas_file)
-    atlas_labels = atlas_nii.get_data()
-    
-    # Atlas voxel volume in mm^3 (microliters)
-    atlas_vox_vol_ul = np.array(atlas_nii.header.get_zooms()).prod()
-    
-    # Create list of unique label values
-    labels = np.unique(atlas_labels)
+    # All label volumes from a single bincount
+    _, labels, vol_vox, vol_ul = file_volumes(atlas_file, mode='label')
 
     # Column headers
     print('%6s %10s %10s' % ('Label', 'Voxels', 'ul'))
     
-    for label in labels:
-
-        # Skip label 0 (background)
-        if label > 0:
-
-            # Extract target label as a boolean mask        
-            label_mask = (atlas_labels == label)
-            
-            # Integrate volume of current label
-            label_vol_vox = np.sum(label_mask)
-            label_vol_ul = label_vol_vox * atlas_vox_vol_ul
-            
-            # Only output non-empty labels with index > 0
-            if label_vol_ul > 0.0:
-                print('%6d %10d %10.1f' % (label, label_vol_vox, label_vol_ul))
+    # Only non-empty labels with index > 0 are returned
+    for label, label_vol_vox, label_vol_ul in zip(labels, vol_vox, vol_ul):
+        print('%6d %10d %10.1f' % (label, label_vol_vox, label_vol_ul))
     
     # Clean exit
     sys.exit(0)
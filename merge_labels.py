@@ -4,12 +4,13 @@ Merge separate segmentation volumens, with one ONLY one label per volume, into o
 
 Usage
 ----
-merge_labels.py <out label image> <first input label image>  <second input label image> ...
+merge_labels.py [-p {first,last,report}] [-j <n threads>] <out label image> <first input label image>  <second input label image> ...
 merge_labels.py -h
 
 Example
 ----
 >>> merge_labels.py atlas.nii.gz seg_1.nii.gz seg_2.nii.gz 
+>>> merge_labels.py -p report -j 8 atlas.nii.gz seg_*.nii.gz
 
 Authors
 ----
@@ -18,6 +19,7 @@ Wolfgang M. Pauli, Caltech, Division of Humaninities and Social Sciences
 Dates
 ----
 2015-05-02 WMP From scratch
+2026-10-18 Threaded streaming merge, compact output type and overlap policies
 
 License
 ----
@@ -43,54 +45,165 @@ Copyright
 
 __version__ = '0.1.0'
 
+import os
 import sys
 import argparse
+from multiprocessing.pool import ThreadPool
 import nibabel as nib
 import numpy as np
+from nibabel.openers import ImageOpener
+from nibabel.fileslice import fileslice
 
 
 def main():
     
     # Parse command line arguments
-    parser = argparse.ArgumentParser(description='Smooth one or more atlas labels')
-    parser.add_argument('out_file', help="smoothed atlas labels filename")
+    parser = argparse.ArgumentParser(description='Merge single label volumes into one label volume')
+    parser.add_argument('out_file', help="merged atlas labels filename")
     parser.add_argument('in_files', metavar='N', type=str, nargs='+',
-                        help='label numbers to smooth')
+                        help='single label volumes (label number = position in list)')
+    parser.add_argument('-p', '--policy', choices=['first', 'last', 'report'], default='last',
+                        help="Overlap policy: first or last input wins, or clear and report conflicts [last]")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of reading threads [1]")
     
     args = parser.parse_args()
     
     out_file = args.out_file
     in_files = args.in_files
+    policy = args.policy
     
-    # Load label image
-    print('Opening first input file to use as reference')
-    in_nii = nib.load(in_files[0])
-    out_labels = np.zeros_like(in_nii.get_data())
+    # Reference geometry from first input header (no image data loaded)
+    print('Using %s as reference' % in_files[0])
+    ref_nii = nib.load(in_files[0])
+    shape = ref_nii.shape[:3]
 
-    for i in xrange(len(in_files)):
-        in_file = in_files[i]
+    # Smallest unsigned type holding all label numbers
+    out_dtype = np.uint8 if len(in_files) < 256 else np.uint16
+    out_labels = np.zeros(shape, dtype=out_dtype)
 
-        # Load the source atlas image
-        print('Processing %s' % in_file)
-        in_nii = nib.load(in_file)
-            
-        # Load label image
-        src_labels = in_nii.get_data()
-        out_labels[np.where(src_labels)] = i + 1
+    # Running count of inputs covering each voxel
+    count = np.zeros(shape, dtype=out_dtype)
 
+    # Merge masks as they arrive from the reading threads
+    # Winners depend only on input position, not arrival order
+    with ThreadPool(max(1, args.jobs)) as pool:
 
-    # Save smoothed labels image
+        for i, bb, mask in pool.imap_unordered(load_mask, [(i, f, shape) for i, f in enumerate(in_files)]):
+
+            if mask is None:
+                continue
+
+            label = i + 1
+            out_block, count_block = out_labels[bb], count[bb]
+
+            count_block[mask] += 1
+
+            if policy == 'first':
+                win = mask & ((out_block == 0) | (out_block > label))
+            else:
+                win = mask & (out_block < label)
+
+            out_block[win] = label
+
+    # Report overlapping inputs
+    n_conflict = np.count_nonzero(count > 1)
+    print('%d voxels covered by more than one input' % n_conflict)
+
+    if policy == 'report' and n_conflict > 0:
+
+        # Clear conflicting voxels and save the count volume for inspection
+        out_labels[count > 1] = 0
+
+        # Strip extension from output basename only
+        out_stub, out_ext = os.path.splitext(out_file)
+        if out_ext == '.gz':
+            out_stub, _ = os.path.splitext(out_stub)
+        count_file = out_stub + '_conflicts.nii.gz'
+        print('Saving input counts to %s' % count_file)
+        nib.Nifti1Image(count, ref_nii.affine).to_filename(count_file)
+
+    # Save merged labels image
     print('Saving merged labels to %s' % out_file)
-    out_nii = nib.Nifti1Image(out_labels, in_nii.get_affine())
+    out_nii = nib.Nifti1Image(out_labels, ref_nii.affine)
     out_nii.to_filename(out_file)
 
-    
     print('Done')
     
     # Clean exit
     sys.exit(0)
 
 
+def load_mask(job, slab=16):
+    """
+    Stream one input as z-slabs and return a boolean mask cropped to its nonzero bounding box
+    - slabs are read in file order from a single open file
+    - all-zero slabs are dropped as they arrive; only non-empty slabs contribute
+      to the bounding box and are kept
+
+    Parameters
+    ----------
+    job: tuple
+        (input index, input filename, reference shape)
+    slab: int
+        z-slab thickness in voxels
+
+    Returns
+    -------
+    i: int
+        input index
+    bb: tuple of slices
+        mask bounding box within the reference volume
+    mask: 3D numpy bool array
+        cropped mask, or None for an empty input
+    """
+
+    i, in_file, shape = job
+
+    print('Processing %s' % in_file)
+    nii = nib.load(in_file)
+    proxy = nii.dataobj
+
+    if proxy.shape[:3] != tuple(shape) or int(np.prod(proxy.shape[3:])) != 1:
+        print('* %s does not match reference dimensions - skipping' % in_file)
+        return i, None, None
+
+    nz = shape[2]
+    tail = (0,) * (len(proxy.shape) - 3)
+
+    # Non-empty slabs with their z offsets
+    slabs = []
+    with ImageOpener(nii.get_filename(), 'rb') as fobj:
+        for z0 in range(0, nz, slab):
+            sliceobj = (slice(None), slice(None), slice(z0, min(z0 + slab, nz))) + tail
+            raw = fileslice(fobj, sliceobj, proxy.shape, proxy.dtype, proxy.offset, order='F')
+            m = (raw * proxy.slope + proxy.inter) != 0
+            if m.any():
+                slabs.append((z0, m))
+
+    # Empty inputs are never merged
+    if not slabs:
+        return i, None, None
+
+    # Bounding box from projections of the non-empty slabs
+    xproj = np.logical_or.reduce([m.any(axis=(1, 2)) for _, m in slabs])
+    yproj = np.logical_or.reduce([m.any(axis=(0, 2)) for _, m in slabs])
+    zfirst = slabs[0][0] + np.flatnonzero(slabs[0][1].any(axis=(0, 1)))[0]
+    zlast = slabs[-1][0] + np.flatnonzero(slabs[-1][1].any(axis=(0, 1)))[-1]
+
+    xx = slice(np.flatnonzero(xproj)[0], np.flatnonzero(xproj)[-1] + 1)
+    yy = slice(np.flatnonzero(yproj)[0], np.flatnonzero(yproj)[-1] + 1)
+    bb = (xx, yy, slice(zfirst, zlast + 1))
+
+    # Assemble cropped mask from the kept slabs
+    mask = np.zeros([xx.stop - xx.start, yy.stop - yy.start, zlast + 1 - zfirst], dtype=bool)
+    for z0, m in slabs:
+        z1 = z0 + m.shape[2]
+        a, b = max(z0, zfirst), min(z1, zlast + 1)
+        mask[:, :, a - zfirst:b - zfirst] = m[xx, yy, a - z0:b - z0]
+
+    return i, bb, mask
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
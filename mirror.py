@@ -2,15 +2,17 @@
 """
 Flip 3D (xyz) or 4D (xyzt) data volume in x, WITHOUT ALTERING THE HEADER
 The usual caveats apply. ONLY RUN THIS ON ABSTRACTED DATA (eg atlases)
+- streams z-slabs of each volume in the on-disk data type, so memory use does
+  not grow with the number of volumes
 
 Usage
 ----
-mirror.py <3D or 4D image>
+mirror.py -i <3D or 4D image> -o <mirrored image> [-s <slab thickness>]
 mirror.py -h
 
 Example
 ----
->>> mirror.py atlas_labels.py
+>>> mirror.py -i atlas_labels.nii.gz -o atlas_labels_mirror.nii.gz
 
 Authors
 ----
@@ -20,6 +22,7 @@ Dates
 ----
 2015-07-31 JMT From scratch
 2016-03-25 JMT Explicit output filename
+2026-10-18 Constant memory streaming in original on-disk data type
 
 License
 ----
@@ -48,7 +51,10 @@ __version__ = '0.2.0'
 import os
 import sys
 import argparse
+import numpy as np
 import nibabel as nib
+from nibabel.openers import ImageOpener
+from nibabel.fileslice import fileslice
 
 
 def main():
@@ -57,6 +63,7 @@ def main():
     parser = argparse.ArgumentParser(description='Mirror data in x without header adjustment')
     parser.add_argument('-i','--in_file', required=True, help="Input Nifti 3D or 4D volume")
     parser.add_argument('-o','--out_file', required=True, help="Output mirrored version of input image")
+    parser.add_argument('-s','--slab', type=int, default=16, help="z-slab thickness in voxels [16]")
 
     # Parse command line arguments
     args = parser.parse_args()
@@ -67,27 +74,60 @@ def main():
     in_file = os.path.abspath(in_file)
     out_file = os.path.abspath(out_file)
 
-    # Open and load Nifti image
+    # Open Nifti image (header only)
     in_nii = nib.load(in_file)
-    in_data = in_nii.get_data()
-
-    nd = in_data.ndim
-
-    # Flip image data in first dimension (x)
-    if nd == 3:
-        out_data = in_data[::-1,:,:]
-    elif nd == 4:
-        out_data = in_data[::-1,:,:,:]
 
     # Write x-mirrored data with identical header
     print('Saving x-mirrored image to %s' % out_file)
-    out_nii = nib.Nifti1Image(out_data, in_nii.get_affine())
-    out_nii.to_filename(out_file)
+    mirror_x(in_nii, out_file, args.slab)
     
     # Clean exit
     sys.exit(0)
 
 
+def mirror_x(in_nii, out_file, slab=16):
+    """
+    Stream x-mirrored raw image data to a new file with an identical header
+    - data are read and written one z-slab of one volume at a time
+    - raw on-disk values are copied, so data type and scaling are unchanged
+
+    Parameters
+    ----------
+    in_nii: Nifti image
+        single file Nifti image opened with nib.load
+    out_file: string
+        output image filename (.nii or .nii.gz)
+    slab: int
+        z-slab thickness in voxels
+    """
+
+    proxy = in_nii.dataobj
+    shape, dtype, offset = proxy.shape, proxy.dtype, proxy.offset
+
+    nx, ny, nz = shape[:3]
+    nt = int(np.prod(shape[3:]))
+
+    # Header is copied unchanged, restoring the on-disk scaling held by the proxy
+    hdr = in_nii.header.copy()
+    hdr.set_slope_inter(proxy.slope, proxy.inter)
+
+    with ImageOpener(in_nii.get_filename(), 'rb') as in_fobj, ImageOpener(out_file, 'wb') as out_fobj:
+
+        hdr.write_to(out_fobj)
+
+        # Pad to start of voxel data
+        out_offset = int(hdr.get_data_offset())
+        out_fobj.write(b'\x00' * (out_offset - out_fobj.tell()))
+
+        # Fortran ordered data - each (t, z-slab) block is contiguous on disk
+        for t in range(nt):
+            tt = np.unravel_index(t, shape[3:], order='F') if nt > 1 else ()
+            for z0 in range(0, nz, slab):
+                sliceobj = (slice(None), slice(None), slice(z0, min(z0 + slab, nz))) + tuple(tt)
+                block = fileslice(in_fobj, sliceobj, shape, dtype, offset, order='F')
+                out_fobj.write(block[::-1, ...].tobytes(order='F'))
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
@@ -4,7 +4,7 @@ Convert single Nifti-1 3D or 4D volume to set of JPEG stacks.
 
 Usage
 ----
-nifti2jpg.py -i <Nifti filename> -o <JPEG image stub>
+nifti2jpg.py -i <Nifti filename> -o <JPEG image stub> [-r <min> <max>] [-a <axis>] [-j <n threads>] [-f]
 nifti2jpg.py -h
 
 Example
@@ -18,6 +18,7 @@ Mike Tyszka, Caltech Brain Imaging Center
 Dates
 ----
 2015-09-03 JMT From scratch
+2026-10-18 Use shared threaded slice exporter (nifti_slices.py)
 
 License
 ----
@@ -43,12 +44,12 @@ Copyright
 
 __version__ = '0.1.0'
 
-import os
 import sys
-import cv2
 import argparse
-import nibabel as nib
-import numpy as np
+import cv2
+
+import nifti_slices
+
 
 def main():
     
@@ -56,61 +57,16 @@ def main():
     parser = argparse.ArgumentParser(description='Convert 3D Nifti volume to JPEG stack')
     parser.add_argument('-i','--nii_file', help='3D or 4D Nifti image')
     parser.add_argument('-o','--jpg_stub', help='JPEG stack stub')
+    nifti_slices.add_arguments(parser)
     
     args = parser.parse_args()
     
     nii_file = args.nii_file
     jpg_stub = args.jpg_stub
     
-    # Strip extension from Nifti filename for use as a stub
-    nii_stub, fext = os.path.splitext(nii_file)
-    if fext == '.gz':
-        nii_stub, _ = os.path.splitext(nii_stub)
-    
-    # Load nifti volume
-    print('Opening Nifti-1 volume')
-    nii_obj = nib.load(nii_file)
-            
-    # Image dimensions
-    nx,ny,nz,nt = nii_obj.header.get_data_shape()
-
-    # Load image data
-    print('Loading voxel data')
-    s = nii_obj.get_data()
-    
-    print('  Matrix size : (%d, %d, %d, %d)' % (nx, ny, nz, nt))
-
-    # Rescale to 0..255 uint8
-    imin, imax = np.min(s), np.max(s)
-    
-    print('  Voxel intensity range : [%0.3f, %0.3f]' % (imin, imax))    
-    
-    s = np.uint8(255.0 * (s - imin) / (imax - imin))
-    
-    # Loop over each volume
-    for t in range(0, nt):
-
-        # Image stack output directory name
-        jpg_dir = nii_stub + '_%04d' % t
-
-        print('  Volume %d -> %s' % (t, jpg_dir))
-        
-        # Create jpg_dir if necessary
-        if not os.path.exists(jpg_dir):
-            os.makedirs(jpg_dir)
-            
-        # Current volume
-        st = s[:,:,:,t]
-        
-        # Loop over each z-slice, outputting as JPEG
-        for z in range(0, nz):
-    
-            # JPEG filename
-            jpg_path = os.path.join(jpg_dir, jpg_stub + '_%04d.jpg' % z)
-            
-            # Write single byte image slice to jpg file
-            sz_rgb = cv2.cvtColor(st[:,:,z], cv2.COLOR_GRAY2RGB)
-            cv2.imwrite(jpg_path, sz_rgb)
+    # Export all slices of all volumes
+    nifti_slices.export_slices(nii_file, jpg_stub, 'jpg', write_jpg,
+                               minmax=args.minmax, axis=args.axis, n_jobs=args.jobs, force=args.force)
 
     print('Done')
     
@@ -118,6 +74,14 @@ def main():
     sys.exit(0)
 
 
+def write_jpg(jpg_path, slice_u8):
+    """
+    Write single byte image slice to RGB JPEG file
+    """
+
+    cv2.imwrite(jpg_path, cv2.cvtColor(slice_u8, cv2.COLOR_GRAY2RGB))
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
@@ -4,7 +4,7 @@ Convert single Nifti-1 3D or 4D volume to set of PNG stacks.
 
 Usage
 ----
-nifti2png.py -i <Nifti filename> -o <PNG image stub>
+nifti2png.py -i <Nifti filename> -o <PNG image stub> [-r <min> <max>] [-a <axis>] [-j <n threads>] [-f]
 nifti2png.py -h
 
 Example
@@ -18,6 +18,7 @@ Mike Tyszka, Caltech Brain Imaging Center
 Dates
 ----
 2016-06-28 JMT Adapt from nifti2jpg.py
+2026-10-18 Use shared threaded slice exporter (nifti_slices.py)
 
 License
 ----
@@ -43,12 +44,12 @@ Copyright
 
 __version__ = '0.1.0'
 
-import os
 import sys
 import argparse
-import nibabel as nib
-import numpy as np
-from skimage import io, color, exposure
+from skimage import io, color
+
+import nifti_slices
+
 
 def main():
 
@@ -56,7 +57,7 @@ def main():
     parser = argparse.ArgumentParser(description='Convert 3D Nifti volume to 8-bit RGB PNG stack')
     parser.add_argument('-i', '--nii_file', required=True, help='3D or 4D Nifti image')
     parser.add_argument('-o', '--png_stub', required=False, help='PNG stack stub')
-    parser.add_argument('-r', '--minmax', required=False, nargs=2, help='Intensity limits imposed on input before 8-bit scaling')
+    nifti_slices.add_arguments(parser)
 
     # Parse arguments
     args = parser.parse_args()
@@ -67,71 +68,9 @@ def main():
     else:
         png_stub = 'slice'
 
-
-    # Strip extension from Nifti filename for use as a stub
-    nii_stub, fext = os.path.splitext(nii_file)
-    if fext == '.gz':
-        nii_stub, _ = os.path.splitext(nii_stub)
-
-    # Load nifti volume
-    print('Opening Nifti-1 volume')
-    nii_obj = nib.load(nii_file)
-
-    # Get image header
-    hdr = nii_obj.header
-
-    # Image dimensions
-    nii_shape = hdr.get_data_shape()
-    if len(nii_shape) == 3:
-        nx, ny, nz = nii_shape
-        nt = 1
-    else:
-        nx, ny, nz, nt = nii_shape
-
-    # Load image data
-    print('Loading voxel data')
-    s = nii_obj.get_data()
-
-    print('  Matrix size : (%d, %d, %d, %d)' % (nx, ny, nz, nt))
-
-    # Clamp input range if requested
-    if args.minmax:
-        imin, imax = float(args.minmax[0]), float(args.minmax[1])
-    else:
-        imin, imax = np.min(s), np.max(s)
-
-    # Rescale to 0..255 uint8
-    print('  Input intensity range : [%0.3f, %0.3f]' % (imin, imax))
-    print('  Output intensity range : [0.0, 1.0]')
-    s = exposure.rescale_intensity(s, in_range=(imin, imax), out_range=(0.0, 1.0))
-
-    # Loop over each volume
-    for t in range(0, nt):
-
-        # Image stack output directory name
-        png_dir = nii_stub + '_%04d' % t
-
-        print('  Volume %d -> %s' % (t,png_dir))
-
-        # Create png_dir if necessary
-        if not os.path.exists(png_dir):
-            os.makedirs(png_dir)
-
-        # Current volume
-        if nt > 1:
-            st = s[:,:,:,t]
-        else:
-            st = s[:,:,:]
-
-        # Loop over each z-slice, outputting as JPEG
-        for z in range(0, nz):
-
-            # PNG filename
-            png_path = os.path.join(png_dir, png_stub + '_%04d.png' % z)
-
-            # Write single byte image slice to jpg file
-            sz_rgb = color.gray2rgb(st[:,:,z])
-            io.imsave(png_path, sz_rgb)
+    # Export all slices of all volumes
+    nifti_slices.export_slices(nii_file, png_stub, 'png', write_png,
+                               minmax=args.minmax, axis=args.axis, n_jobs=args.jobs, force=args.force)
 
     print('Done')
 
@@ -139,6 +78,14 @@ def main():
     sys.exit(0)
 
 
+def write_png(png_path, slice_u8):
+    """
+    Write single byte image slice to RGB PNG file
+    """
+
+    io.imsave(png_path, color.gray2rgb(slice_u8))
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
 
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+Shared slice export engine for nifti2png.py and nifti2jpg.py
+- each volume is scaled on the fly through one reusable float32 work array
+  into a reusable uint8 buffer
+- slices are encoded in a thread pool (PNG and JPEG encoders release the GIL)
+- any slicing axis
+- slices newer than the Nifti image are skipped unless forced or exported
+  with a different axis or intensity range (recorded in a JSON sidecar)
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+Dates
+----
+2026-10-18 Split from nifti2png.py and nifti2jpg.py
+
+License
+----
+This file is part of atlaskit.
+
+    atlaskit is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    atlaskit is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with atlaskit.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright
+----
+2026 California Institute of Technology.
+"""
+
+__version__ = '0.1.0'
+
+import os
+import json
+from multiprocessing.pool import ThreadPool
+import nibabel as nib
+import numpy as np
+
+
+def add_arguments(parser):
+    """
+    Slice export options common to nifti2png.py and nifti2jpg.py
+    """
+
+    parser.add_argument('-r', '--minmax', required=False, nargs=2,
+                        help='Intensity limits imposed on input before 8-bit scaling')
+    parser.add_argument('-a', '--axis', required=False, type=int, default=2, choices=[0, 1, 2],
+                        help='Slicing axis (0 = x, 1 = y, 2 = z) [2]')
+    parser.add_argument('-j', '--jobs', required=False, type=int, default=1,
+                        help='Number of slice encoding threads [1]')
+    parser.add_argument('-f', '--force', action='store_true', default=False,
+                        help='Rewrite slices that are already up to date')
+
+
+def export_slices(nii_file, slice_stub, ext, write_slice, minmax=None, axis=2, n_jobs=1, force=False):
+    """
+    Export every slice of every volume of a 3D or 4D Nifti image as 8-bit images
+    - output directories are <nii stub>_<volume> for z slices and <nii stub>_<x|y>_<volume>
+      for x and y slices, slices <slice stub>_<slice>.<ext>
+    - export parameters are stored in <slice stub>.json in each directory and slices
+      exported with other parameters are rewritten
+
+    Parameters
+    ----------
+    nii_file: string
+        3D or 4D Nifti image filename
+    slice_stub: string
+        slice filename stub
+    ext: string
+        slice file extension (eg 'png')
+    write_slice: function
+        write_slice(path, 2D uint8 array) encodes and saves one slice
+    minmax: tuple or None
+        intensity limits for 8-bit scaling [image min and max]
+    axis: int
+        slicing axis
+    n_jobs: int
+        number of slice encoding threads
+    force: bool
+        rewrite slices already newer than the Nifti image
+
+    Returns
+    -------
+    n_written: int
+        number of slices written
+    """
+
+    # Strip extension from Nifti filename for use as a stub
+    nii_stub, fext = os.path.splitext(nii_file)
+    if fext == '.gz':
+        nii_stub, _ = os.path.splitext(nii_stub)
+
+    # Load nifti header only
+    print('Opening Nifti-1 volume')
+    nii_obj = nib.load(nii_file)
+    nii_mtime = os.path.getmtime(nii_file)
+
+    # Image dimensions
+    nii_shape = nii_obj.header.get_data_shape()
+    nt = nii_shape[3] if len(nii_shape) > 3 else 1
+    vol_shape = nii_shape[:3]
+    n_slices = vol_shape[axis]
+
+    print('  Matrix size : (%d, %d, %d, %d)' % (vol_shape + (nt,)))
+
+    # Export parameters compared against each directory's sidecar
+    params = {'axis': axis, 'minmax': [float(m) for m in minmax] if minmax else None}
+    dir_stub = nii_stub if axis == 2 else nii_stub + '_' + 'xyz'[axis]
+
+    # Slices still to be written for each volume
+    todo = []
+    for t in range(nt):
+        slice_dir = dir_stub + '_%04d' % t
+        sidecar = os.path.join(slice_dir, slice_stub + '.json')
+        rewrite = force or read_sidecar(sidecar) != params
+        paths = [os.path.join(slice_dir, slice_stub + '_%04d.%s' % (k, ext)) for k in range(n_slices)]
+        stale = [k for k, path in enumerate(paths)
+                 if rewrite or not os.path.isfile(path) or os.path.getmtime(path) < nii_mtime]
+        todo.append((slice_dir, paths, stale))
+
+    if not any(stale for _, _, stale in todo):
+        print('  All slices up to date')
+        return 0
+
+    # Intensity limits - streamed over volumes if not supplied
+    if minmax:
+        imin, imax = float(minmax[0]), float(minmax[1])
+    else:
+        imin, imax = np.inf, -np.inf
+        for t in range(nt):
+            vol = read_volume(nii_obj, t, nt)
+            imin, imax = min(imin, vol.min()), max(imax, vol.max())
+
+    print('  Input intensity range : [%0.3f, %0.3f]' % (imin, imax))
+
+    # Two reusable uint8 buffers - one is scaled while the other is encoded
+    bufs = [np.zeros(vol_shape, dtype=np.uint8) for _ in range(2)]
+    work = np.empty(vol_shape, dtype=np.float32)
+    pending = [None, None]
+    n_written = 0
+
+    with ThreadPool(max(1, n_jobs)) as pool:
+
+        for t, (slice_dir, paths, stale) in enumerate(todo):
+
+            if not stale:
+                continue
+
+            print('  Volume %d -> %s (%d slices)' % (t, slice_dir, len(stale)))
+
+            # Create slice directory if necessary
+            os.makedirs(slice_dir, exist_ok=True)
+
+            # Wait for encoding of the volume previously held in this buffer
+            b = t % 2
+            if pending[b] is not None:
+                pending[b].get()
+
+            scale_uint8(read_volume(nii_obj, t, nt), imin, imax, bufs[b], work)
+
+            # Slice views into the buffer along the requested axis
+            slices = np.moveaxis(bufs[b], axis, 0)
+            jobs = [(write_slice, paths[k], slices[k]) for k in stale]
+            pending[b] = pool.starmap_async(encode_slice, jobs)
+            n_written += len(jobs)
+
+        for p in pending:
+            if p is not None:
+                p.get()
+
+    # Record export parameters once all slices are on disk
+    for slice_dir, _, stale in todo:
+        if stale:
+            with open(os.path.join(slice_dir, slice_stub + '.json'), 'w') as fd:
+                json.dump(params, fd)
+
+    return n_written
+
+
+def read_sidecar(sidecar):
+    """
+    Export parameters from a slice directory sidecar, or None if missing or unreadable
+    """
+
+    try:
+        with open(sidecar, 'r') as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def read_volume(nii_obj, t, nt):
+    """
+    Read one 3D volume of a 3D or 4D image through its array proxy
+    """
+
+    if nt > 1:
+        return np.asanyarray(nii_obj.dataobj[..., t])
+    else:
+        return np.asanyarray(nii_obj.dataobj).reshape(nii_obj.shape[:3])
+
+
+def scale_uint8(vol, imin, imax, buf, work):
+    """
+    Scale a volume to 0..255 into an existing uint8 buffer, clamping to [imin, imax]
+    - work is a float32 array of the volume shape reused between calls
+    """
+
+    scale = 255.0 / (imax - imin) if imax > imin else 0.0
+
+    np.subtract(vol, imin, out=work, dtype=np.float32, casting='unsafe')
+    work *= scale
+    np.clip(work, 0.0, 255.0, out=work)
+    np.copyto(buf, work, casting='unsafe')
+
+
+def encode_slice(write_slice, path, img):
+    """
+    Encode one slice in a pool thread
+    """
+
+    write_slice(path, np.ascontiguousarray(img))
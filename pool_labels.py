@@ -4,12 +4,20 @@ Pool/Combine one or more labels within an integer atlas volume
 
 Usage
 ----
-pool_labels.py <input label image> <output label image> <input label numbers> <output label number>
+pool_labels.py <input label image> <output label image> <output label number> <input label numbers>
+pool_labels.py -m <mapping file> <input label image> <output label image>
 pool_labels.py -h
 
+Mapping file
+----
+One pooling rule per line, applied in order (later rules see the output of earlier rules)
+<output label number> <input label number> [<input label number> ...]
+Lines starting with # are ignored
+
 Example
 ----
 >>> pool_labels.py atlas.nii.gz atlas_1.nii.gz 1 12 13 14
+>>> pool_labels.py -m hierarchy.txt atlas.nii.gz atlas_pooled.nii.gz
 
 Authors
 ----
@@ -47,7 +55,6 @@ __version__ = '0.1.0'
 
 import sys
 import argparse
-from scipy.ndimage.filters import gaussian_filter
 import nibabel as nib
 import numpy as np
 
@@ -57,45 +64,55 @@ def main():
     parser = argparse.ArgumentParser(description='Pool one or more atlas labels')
     parser.add_argument('in_file', help="source atlas labels filename")
     parser.add_argument('out_file', help="pooled atlas labels filename")
-    parser.add_argument('out_label', metavar='out_label', type=int, help='one label number to renumber in_labels to')
-    parser.add_argument('in_labels', metavar='in_label', type=int, nargs='+',
+    parser.add_argument('out_label', metavar='out_label', type=int, nargs='?',
+                        help='one label number to renumber in_labels to')
+    parser.add_argument('in_labels', metavar='in_label', type=int, nargs='*',
                         help='two label numbers to change')
+    parser.add_argument('-m', '--mapping', help="pooling rules file (one 'out_label in_labels ...' rule per line)")
 
     args = parser.parse_args()
 
     in_file = args.in_file
     out_file = args.out_file
-    in_labels = args.in_labels
-    out_label = args.out_label
+
+    # Pooling rules from mapping file or command line
+    if args.mapping:
+        rules = load_rules(args.mapping)
+    elif args.out_label is not None and args.in_labels:
+        rules = [(args.out_label, args.in_labels)]
+        if min([args.out_label] + args.in_labels) < 0:
+            print('* Label numbers must be non-negative - exiting')
+            sys.exit(1)
+    else:
+        print('* Provide output and input label numbers or a mapping file - exiting')
+        sys.exit(1)
         
     # Load the source atlas image
     print('Opening %s' % in_file)
     in_nii = nib.load(in_file)
     
-    # Load label image
+    # Load label image, keeping integer on-disk type
     print('Loading labels')
-    src_labels = in_nii.get_data()
-        
-    print('Pooling desired labels')
-    out_labels = np.zeros_like(src_labels)
-    for label in in_labels:
-        # Extract target label as a boolean mask
-        out_labels += (src_labels == label)
-
-    # Renumber target label region
-    out_labels *= out_label
-  
-    print('Copying all other labels from original')
-    for label in np.unique(src_labels):
-        if (label in in_labels) or label == out_label or label == 0:
-            continue
-        else:
-            ind = np.where(src_labels == label)
-            out_labels[ind] = label
+    src_labels = np.asanyarray(in_nii.dataobj)
+    if not np.issubdtype(src_labels.dtype, np.integer):
+        src_labels = np.rint(src_labels).astype(np.int32)
+
+    print('Pooling desired labels (%d rules)' % len(rules))
+    lut, lo = pooling_lut(rules, src_labels.min(initial=0), src_labels.max(initial=0))
+
+    # Keep source dtype if it can hold every output label, otherwise promote
+    src_info = np.iinfo(src_labels.dtype)
+    if src_info.min <= lut.min() and lut.max() <= src_info.max:
+        out_dtype = src_labels.dtype
+    else:
+        out_dtype = np.promote_types(src_labels.dtype, np.min_scalar_type(lut.max()))
+
+    # Single lookup table pass over the volume
+    out_labels = np.take(lut.astype(out_dtype), src_labels - lo if lo else src_labels)
     
     # Save changed labels image
     print('Saving changed labels to %s' % out_file)
-    out_nii = nib.Nifti1Image(out_labels, in_nii.get_affine())
+    out_nii = nib.Nifti1Image(out_labels, in_nii.affine)
     out_nii.to_filename(out_file)
     
     print('Done')
@@ -104,6 +121,72 @@ def main():
     sys.exit(0)
 
 
+def load_rules(mapping_fname):
+    """
+    Load pooling rules from a mapping file
+
+    Parameters
+    ----------
+    mapping_fname: string
+        one '<out_label> <in_label> [<in_label> ...]' rule per line, non-negative labels only
+
+    Returns
+    -------
+    rules: list of (out_label, in_labels) tuples
+    """
+
+    rules = []
+
+    with open(mapping_fname) as fd:
+        for line in fd:
+            fields = line.split('#')[0].split()
+            if len(fields) > 1:
+                labels = [int(f) for f in fields]
+                if min(labels) < 0:
+                    print('* Negative label in pooling rule "%s" - exiting' % line.strip())
+                    sys.exit(1)
+                rules.append((labels[0], labels[1:]))
+
+    if not rules:
+        print('* No pooling rules found in %s - exiting' % mapping_fname)
+        sys.exit(1)
+
+    return rules
+
+
+def pooling_lut(rules, lo, hi):
+    """
+    Compose pooling rules into a single label lookup table
+    - labels not named in any rule map to themselves
+    - rules are applied in order, so hierarchical merges can pool earlier outputs
+
+    Parameters
+    ----------
+    rules: list of (out_label, in_labels) tuples
+    lo, hi: int
+        label range present in the source volume
+
+    Returns
+    -------
+    lut: numpy integer array
+        output label for source label lo + i at index i
+    lo: int
+        label offset of the table
+    """
+
+    # Cover source labels and all rule labels
+    rule_labels = [l for out_label, in_labels in rules for l in [out_label] + list(in_labels)]
+    lo = min(int(lo), min(rule_labels), 0)
+    hi = max(int(hi), max(rule_labels))
+
+    # Identity table, then pool in rule order
+    lut = np.arange(lo, hi + 1)
+    for out_label, in_labels in rules:
+        lut[np.isin(lut, in_labels)] = out_label
+
+    return lut, lo
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
@@ -48,6 +48,8 @@ import matplotlib.pyplot as plt
 from skimage.exposure import rescale_intensity
 from skimage import color
 
+from atlas_pyramid import select_factor, pyramid_fname
+
 __version__ = '0.1'
 
 
@@ -58,6 +60,8 @@ def main():
     parser.add_argument('-a', '--atlasdir', required=False, help='Directory containing probabilistic atlas [.]')
     parser.add_argument('-r', '--rois', required=False, help='ROI specification file [<atlasdir>/rois.txt]')
     parser.add_argument('--bilateral', action='store_true', default=False, help='Use bilateral labels')
+    parser.add_argument('-t', '--target', required=False, type=float, default=0.0,
+                        help='Target pixel size in mm for preview pyramid level selection [full resolution]')
 
     # Parse command line arguments
     args = parser.parse_args()
@@ -100,9 +104,29 @@ def main():
     print('Bilateral         : %s' % ('Yes' if args.bilateral else 'No'))
     print('')
 
+    T1w_fname = os.path.join(atlas_dir, 'T1w_template.nii.gz')
+    T2w_fname = os.path.join(atlas_dir, 'T2w_template.nii.gz')
+    if args.bilateral:
+        prob_fname = os.path.join(atlas_dir, 'prob_atlas_bilateral.nii.gz')
+    else:
+        prob_fname = os.path.join(atlas_dir, 'prob_atlas.nii.gz')
+
+    # Use the coarsest preview pyramid level meeting the target pixel size
+    pyr_dir = os.path.join(atlas_dir, 'pyramid')
+    if args.target > 0.0:
+        f = select_factor([T1w_fname, T2w_fname, prob_fname], args.target, pyr_dir=pyr_dir)
+    else:
+        f = 1
+
+    if f > 1:
+        print('Pyramid level     : %dx downsampled' % f)
+        print('')
+        T1w_fname, T2w_fname, prob_fname = [pyramid_fname(fname, f, pyr_dir)
+                                            for fname in (T1w_fname, T2w_fname, prob_fname)]
+
     # Load ROI specs
     if os.path.isfile(roi_specfile):
-        rois = load_rois(roi_specfile)
+        rois = scale_rois(load_rois(roi_specfile), f)
     else:
         print('* ROI specification file %s does not exist' % roi_specfile)
         sys.exit(1)
@@ -115,13 +139,11 @@ def main():
 
     # Load T1w template
     print('< Loading T1w template')
-    T1w_fname = os.path.join(atlas_dir, 'T1w_template.nii.gz')
     T1w_nii = nib.load(T1w_fname)
     T1w_img = T1w_nii.get_data()
 
     # Load T2w template
     print('< Loading T2w template')
-    T2w_fname = os.path.join(atlas_dir, 'T2w_template.nii.gz')
     T2w_nii = nib.load(T2w_fname)
     T2w_img = T2w_nii.get_data()
 
@@ -134,11 +156,6 @@ def main():
 
     # Load the 4D probabilistic atlas
     print('< Loading probabilistic image')
-    if args.bilateral:
-        prob_fname = os.path.join(atlas_dir, 'prob_atlas_bilateral.nii.gz')
-    else:
-        prob_fname = os.path.join(atlas_dir, 'prob_atlas.nii.gz')
-
     p_nii = nib.load(prob_fname)
     p_atlas = p_nii.get_data()
 
@@ -257,6 +274,34 @@ def load_rois(roi_specfile):
     return rois
 
 
+def scale_rois(rois, f):
+    """
+    Map full resolution ROI specs to a pyramid level downsampled by f
+    - ROI corners are divided by f, extents rounded up to at least one voxel
+
+    Parameters
+    ----------
+    rois: data frame
+    f: int
+        pyramid downsampling factor
+
+    Returns
+    -------
+    rois: data frame
+    """
+
+    if f == 1:
+        return rois
+
+    rois = rois.copy()
+    for ax in ('x', 'y', 'z'):
+        d = 'd' + ax
+        rois[d] = np.maximum(1, -(-(rois[ax] + rois[d]) // f) - rois[ax] // f)
+        rois[ax] = rois[ax] // f
+
+    return rois
+
+
 def label_rgb2hsv(label_key):
     """
     Extract label RGB colors and convert to HSV
@@ -2,6 +2,7 @@
 """
 Output volumes of each probabilistic label in an atlas in microliters.
 Accepts multiple 4D prob atlas files
+- one line of label volumes per file; see volumetrics.py for tidy CSV output
 
 Usage
 ----
@@ -19,6 +20,7 @@ Mike Tyszka, Caltech Brain Imaging Center
 Dates
 ----
 2015-05-31 JMT Adapt from label_volumes.py
+2026-10-18 Vectorized label sums (volumetrics.py), fix output formatting
 
 License
 ----
@@ -47,8 +49,7 @@ __version__ = '0.1.0'
 import os
 import sys
 import argparse
-import nibabel as nib
-import numpy as np
+from volumetrics import file_volumes
 
 
 def main():
@@ -66,31 +67,10 @@ def main():
         # Force absolute path
         p_file = os.path.abspath(p_file)
         
-        # Load the source atlas image
-        p_nii = nib.load(p_file)
-        p = p_nii.get_data()
-        nd = p.ndim
-        
-        # Atlas voxel volume in mm^3 (microliters)
-        atlas_vox_vol_ul = np.array(p_nii.header.get_zooms()).prod()
-        
-        # Treat probabilities as partial volumes and integrate
-        if nd == 3:
-
-            V = np.sum(p) * atlas_vox_vol_ul
-            print('%0.3f' % V) 
-
-        elif nd == 4:
-
-            nx,ny,nz,nt = p.shape
-
-            for t in range(0,nt):
-
-                V = np.sum(p[:,:,:,t]) * atlas_vox_vol_ul
-                print('%0.3f' % V),
+        # Treat probabilities as partial volumes and integrate all labels at once
+        _, _, _, vol_ul = file_volumes(p_file, mode='prob')
 
-            # Final newline
-            print          
+        print(' '.join('%0.3f' % V for V in vol_ul))
     
     # Clean exit
     sys.exit(0)
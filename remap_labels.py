@@ -4,7 +4,7 @@ Use a new key to reorder label numbers in label volumes.
 
 Usage
 ----
-remap_labels.py -ok <Old Key> -nk <New Key> <Label Volumes> ...
+remap_labels.py -ok <Old Key> -nk <New Key> [-j <n threads>] <Label Volumes> ...
 remap_labels.py -h
 
 Example
@@ -45,6 +45,7 @@ __version__ = '0.1.0'
 
 import os, sys
 import argparse
+from multiprocessing.pool import ThreadPool
 import nibabel as nib
 import numpy as np
 import pandas as pd
@@ -56,6 +57,7 @@ def main():
     parser = argparse.ArgumentParser(description='Reorder labels using a new key')
     parser.add_argument('-ok','--oldkey', help="Old ITK-SNAP label key file")
     parser.add_argument('-nk','--newkey', help="New ITK-SNAP label key file")
+    parser.add_argument('-j','--jobs', type=int, default=1, help="Number of label volumes remapped in parallel [1]")
     parser.add_argument('labels', metavar='N', type=str, nargs='+',
                         help='list of label volume files to reorder')
     
@@ -76,7 +78,6 @@ def main():
     # Load new label key
     if os.path.isfile(new_key_fname):
         new_key = LoadKey(new_key_fname)
-        n_new = new_key.shape[0]
     else:
         print('%s does not exist - exiting' % new_key_fname)
         sys.exit(1)
@@ -87,8 +88,8 @@ def main():
         sys.exit(1)
 
     # Construct label mappings
-    i_old = -np.ones([n_old,])
-    i_new = -np.ones([n_new,])
+    i_old = np.zeros([n_old,], dtype=int)
+    i_new = np.zeros([n_old,], dtype=int)
     
     # Init key mapping
     count = 0
@@ -106,7 +107,7 @@ def main():
         else:
             print('%20s: %6d -> %6d' % (old_name, old_idx, new_idx.iloc[0]))
             i_old[count] = old_idx
-            i_new[count] = new_idx
+            i_new[count] = new_idx.iloc[0]
             count += 1
 
     if missing_key:
@@ -115,36 +116,72 @@ def main():
             
     print('\nFound %d mappings between old and new keys' % count)
     
-    # Loop over all label volumes provided
-    for old_fname in label_fnames:
-        
-        # Construct output filename    
-        old_stub, old_ext = os.path.splitext(old_fname)
-        if old_ext == '.gz':
-            old_stub, _ = os.path.splitext(old_stub)
-        new_fname = old_stub + '_remapped.nii.gz'         
-        
-        print('Remapping %s to %s' % (old_fname, new_fname))
-            
-        # Load old label image
-        old_nii = nib.load(old_fname)
-        old_labels = old_nii.get_data()
-        T = old_nii.get_affine()
+    # Integer lookup table from old to new label indices
+    lut = MakeLUT(i_old[:count], i_new[:count])
 
-        # Create zeroed new label image        
-        new_labels = np.zeros_like(old_labels)
-        
-        # Loop over all old label indices
-        for i, old_idx in enumerate(i_old):
-            new_idx = i_new[i]
-            new_labels[old_labels == old_idx] = new_idx
-    
-        new_nii = nib.Nifti1Image(new_labels, T)
-        new_nii.to_filename(new_fname)
+    # Remap all label volumes provided, several at a time
+    with ThreadPool(max(1, args.jobs)) as pool:
+        pool.starmap(RemapVolume, [(old_fname, lut) for old_fname in label_fnames])
    
     print('Done')
     
 
+def MakeLUT(i_old, i_new):
+    '''
+    Integer lookup table mapping old label indices to new label indices
+    - indices absent from the old key map to zero
+    '''
+
+    lut = np.zeros([i_old.max(initial=0) + 1,], dtype=np.min_scalar_type(i_new.max(initial=0)))
+    lut[i_old] = i_new
+
+    return lut
+
+
+def RemapVolume(old_fname, lut):
+    '''
+    Remap a label volume through a lookup table with a single np.take
+    - output keeps the integer on-disk dtype of the input where the new indices fit
+    '''
+
+    # Construct output filename    
+    old_stub, old_ext = os.path.splitext(old_fname)
+    if old_ext == '.gz':
+        old_stub, _ = os.path.splitext(old_stub)
+    new_fname = old_stub + '_remapped.nii.gz'         
+    
+    print('Remapping %s to %s' % (old_fname, new_fname))
+        
+    # Load old label image without float conversion
+    old_nii = nib.load(old_fname)
+    old_labels = np.asanyarray(old_nii.dataobj)
+    if not np.issubdtype(old_labels.dtype, np.integer):
+        old_labels = np.rint(old_labels).astype(np.int32)
+
+    # Extend table with zeros to cover every label present
+    n_lut = max(int(old_labels.max(initial=0)) + 1, lut.size)
+    if n_lut > lut.size:
+        lut = np.concatenate([lut, np.zeros([n_lut - lut.size,], dtype=lut.dtype)])
+
+    # Negative labels fall outside the table and map to zero
+    if old_labels.min(initial=0) < 0:
+        old_labels = old_labels.clip(0)
+
+    # Keep input dtype if it can hold every new index, otherwise promote
+    old_info = np.iinfo(old_labels.dtype)
+    if old_info.min <= lut.min() and lut.max() <= old_info.max:
+        out_dtype = old_labels.dtype
+    else:
+        out_dtype = np.promote_types(old_labels.dtype, lut.dtype)
+
+    new_labels = np.take(lut.astype(out_dtype), old_labels)
+
+    new_nii = nib.Nifti1Image(new_labels, old_nii.affine)
+    new_nii.to_filename(new_fname)
+
+    return new_fname
+
+
 def LoadKey(key_fname):
     '''
     Parse an ITK-SNAP label key file
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 """
 Simple intensity clustering segmentation of 3D grayscale image
+- clusters are fitted on foreground voxels, optionally on a reproducible subsample
+- all voxels are assigned to the nearest centroid in z-slabs using sorted thresholds
+- labels are ordered by increasing centroid intensity
 
 Usage
 ----
 segment.py -i <Grayscale Nifti image> -o <Segmentation image> [-n segments] [-m kmeans]
+    [-k <mask image> | -t <foreground threshold>] [-s <subsample size>] [--seed <seed>]
 
 Authors
 ----
@@ -13,6 +17,7 @@ Mike Tyszka, Caltech Brain Imaging Center
 Dates
 ----
 2016-04-24 JMT From scratch
+2026-10-18 Masked and subsampled fitting, streamed nearest centroid assignment
 
 License
 ----
@@ -42,8 +47,8 @@ import sys
 import argparse
 import numpy as np
 import nibabel as nib
-from sklearn.cluster import KMeans
-from scipy.ndimage.filters import median_filter
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from scipy.ndimage import median_filter
 
 
 def main():
@@ -52,8 +57,16 @@ def main():
     parser = argparse.ArgumentParser(description='Simple image segmenter')
     parser.add_argument('-i', '--input', required=True, help='Input grayscale image')
     parser.add_argument('-o', '--output', required=True, help='Output segmentation labels')
-    parser.add_argument('-m', '--method', required=False, help='Clustering method [KMeans]')
+    parser.add_argument('-m', '--method', required=False, help='Clustering method: KMeans or MiniBatchKMeans [KMeans]')
     parser.add_argument('-n', '--nclusters', required=False, help='Number of clusters [3]')
+    parser.add_argument('-k', '--mask', required=False, help='Foreground mask image [all voxels]')
+    parser.add_argument('-t', '--thresh', required=False, type=float,
+                        help='Foreground intensity threshold, used if no mask is given')
+    parser.add_argument('-s', '--subsample', required=False, type=int, default=0,
+                        help='Fit on a random subsample of this many foreground voxels [all]')
+    parser.add_argument('--seed', required=False, type=int, default=0, help='Random seed [0]')
+    parser.add_argument('--slab', required=False, type=int, default=32,
+                        help='z-slab thickness for voxel assignment [32]')
 
     # Parse command line arguments
     args = parser.parse_args()
@@ -67,46 +80,126 @@ def main():
         seg_method = 'KMeans'
 
     if args.nclusters:
-        n = np.int(args.nclusters)
+        n = int(args.nclusters)
     else:
         n = 3
 
-    # Load grayscale image
+    # Load grayscale image in its on-disk type
     print('Loading grayscale image from %s' % in_file)
     in_nii = nib.load(in_file)
-    in_img = in_nii.get_data()
+    in_img = np.asanyarray(in_nii.dataobj)
+
+    # Foreground mask (None = all voxels)
+    if args.mask:
+        print('Loading foreground mask from %s' % args.mask)
+        mask = np.asanyarray(nib.load(args.mask).dataobj) > 0
+    elif args.thresh is not None:
+        mask = in_img > args.thresh
+    else:
+        mask = None
 
-    # Save dimensions
-    orig_shape = in_img.shape
+    # Foreground intensities for fitting
+    if mask is None:
+        fg = in_img.reshape(-1)
+    else:
+        fg = in_img[mask]
 
-    # Flatten image for segmentation - see sklearn documentation
-    in_img = in_img.reshape(-1,1,order='F')
+    # Reproducible random subsample of foreground voxels
+    if 0 < args.subsample < fg.size:
+        print('Fitting on %d of %d voxels' % (args.subsample, fg.size))
+        rng = np.random.RandomState(args.seed)
+        fg = fg[rng.choice(fg.size, args.subsample, replace=False)]
 
-    # Intensity cluster segmentation
+    # Intensity cluster fit - see sklearn documentation for [N,1] sample shape
     print('Segmenting using %s' % seg_method)
     if seg_method == 'KMeans':
-        k_means = KMeans(init='k-means++', n_init=10, tol=1e-9, n_clusters=n)
-        k_means.fit(in_img)
-        seg_img = k_means.labels_
+        k_means = KMeans(init='k-means++', n_init=10, tol=1e-9, n_clusters=n, random_state=args.seed)
+    elif seg_method == 'MiniBatchKMeans':
+        k_means = MiniBatchKMeans(init='k-means++', n_clusters=n, random_state=args.seed)
     else:
         print('Unknown clustering method : %s' % seg_method)
         sys.exit(1)
 
-    # Restore original image shape
-    seg_img = seg_img.reshape(orig_shape, order='F')
+    k_means.fit(fg.reshape(-1, 1).astype(np.float32))
 
-    # Isolated voxel removal
-    seg_img = median_filter(seg_img, size=(3,3,3))
+    # Nearest centroid assignment of all voxels
+    centroids = np.sort(k_means.cluster_centers_.ravel())
+    seg_img = assign_clusters(in_img, centroids, mask, args.slab)
+
+    # Isolated voxel removal within the foreground bounding box
+    median_bbox(seg_img, mask)
 
     # Write segmentation labels
     print('Saving segmentation to %s' % out_file)
-    out_nii = nib.Nifti1Image(seg_img, in_nii.get_affine())
+    out_nii = nib.Nifti1Image(seg_img, in_nii.affine)
     out_nii.to_filename(out_file)
 
     # Clean exit
     sys.exit(0)
 
 
+def assign_clusters(in_img, centroids, mask=None, slab=32):
+    """
+    Assign voxels to nearest 1D centroid in z-slabs
+    - nearest centroid in 1D is a search of the sorted centroid midpoints
+
+    Parameters
+    ----------
+    in_img: 3D numpy array
+    centroids: numpy array
+        sorted cluster centroids
+    mask: 3D numpy bool array or None
+        foreground mask - foreground labels start at 1 and background is 0
+    slab: int
+        z-slab thickness in voxels
+
+    Returns
+    -------
+    seg_img: 3D numpy uint8 array
+        labels in order of increasing centroid intensity
+    """
+
+    thresholds = 0.5 * (centroids[1:] + centroids[:-1])
+    offset = 0 if mask is None else 1
+
+    seg_img = np.zeros(in_img.shape, dtype=np.uint8)
+    nz = in_img.shape[2]
+
+    for z0 in range(0, nz, slab):
+        zz = slice(z0, min(z0 + slab, nz))
+        labels = np.searchsorted(thresholds, in_img[:, :, zz].astype(np.float32)) + offset
+        if mask is not None:
+            labels[~mask[:, :, zz]] = 0
+        seg_img[:, :, zz] = labels
+
+    return seg_img
+
+
+def median_bbox(seg_img, mask=None, size=3):
+    """
+    In-place median filter of labels restricted to the foreground bounding box
+    - the box is extended by a filter halo so box voxels see their true neighbours
+    """
+
+    h = size // 2
+
+    if mask is None:
+        bb = tuple(slice(0, n) for n in seg_img.shape)
+    else:
+        bb = []
+        for ax in range(3):
+            nz = np.flatnonzero(mask.any(axis=tuple(a for a in range(3) if a != ax)))
+            if nz.size == 0:
+                return
+            bb.append(slice(nz[0], nz[-1] + 1))
+
+    # Filter box with halo, write back box interior
+    bb_h = tuple(slice(max(b.start - h, 0), min(b.stop + h, n)) for b, n in zip(bb, seg_img.shape))
+    filtered = median_filter(seg_img[bb_h], size=(size,) * 3)
+    inner = tuple(slice(b.start - bh.start, b.stop - bh.start) for b, bh in zip(bb, bb_h))
+    seg_img[tuple(bb)] = filtered[inner]
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
\ No newline at end of file
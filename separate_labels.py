@@ -4,12 +4,14 @@ Write separate volume for each label found in the input image
 
 Usage
 ----
-separate_labels.py <input label image>
+separate_labels.py [--int64] [-c] [-f {separate,onehot,packed}] [-j <n threads>] <input label image>
 separate_labels.py -h
 
 Example
 ----
 >>> separate_labels.py atlas.nii.gz 
+>>> separate_labels.py -c -j 8 atlas.nii.gz
+>>> separate_labels.py -f onehot atlas.nii.gz
 
 Authors
 ----
@@ -19,6 +21,7 @@ Dates
 ----
 2015-05-02 WMP From scratch
 2015-07-29 JMT Speed up mask generation, use zero-padded output indexing
+2026-10-18 Compact uint8, cropped and 4D one-hot/packed outputs, threaded writes
 
 License
 ----
@@ -47,15 +50,24 @@ __version__ = '0.2.0'
 import os
 import sys
 import argparse
+from multiprocessing.pool import ThreadPool
 import nibabel as nib
 import numpy as np
+from scipy.ndimage import find_objects
 
 
 def main():
     
     # Parse command line arguments
-    parser = argparse.ArgumentParser(description='Smooth one or more atlas labels')
+    parser = argparse.ArgumentParser(description='Write separate mask for each atlas label')
     parser.add_argument('in_file', help="source atlas labels filename")
+    parser.add_argument('--int64', action='store_true', default=False,
+                        help="Write int64 masks instead of uint8 (previous default)")
+    parser.add_argument('-c', '--crop', action='store_true', default=False,
+                        help="Crop each mask to its label bounding box (affine adjusted)")
+    parser.add_argument('-f', '--format', choices=['separate', 'onehot', 'packed'], default='separate',
+                        help="One file per label, one 4D uint8 one-hot image or one packed-bit NPZ [separate]")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of file writing threads [1]")
     
     args = parser.parse_args()
     
@@ -63,32 +75,72 @@ def main():
     
     # Convert relative to absolute path
     in_file = os.path.abspath(in_file)
+    out_stub = nifti_stub(in_file)
     
     # Load the source atlas image
     print('Opening %s' % in_file)
     in_nii = nib.load(in_file)
     
-    # Load label image
-    src_labels = in_nii.get_data()
-
-    # Construct list of unique label values in image
-    unique_labels = np.unique(src_labels)
-
-    # loop over each unique label value
-    for label in unique_labels:
-        
-        if label > 0:
-        
-            # Create mask for current label value
-            out_mask = (src_labels == label).astype(int)
-            
-            # Construct output filename. Use zero-padded indexing
-            out_file = in_file.strip('.nii.gz') + '_' + '{0:04d}'.format(label) + '.nii.gz'
-            
-            # Save smoothed labels image
-            print('Saving label %d to %s' % (label, out_file))
-            out_nii = nib.Nifti1Image(out_mask, in_nii.get_affine())
-            out_nii.to_filename(out_file)
+    # Load label image, keeping integer on-disk type
+    src_labels = np.asanyarray(in_nii.dataobj)
+
+    # find_objects needs non-negative integer labels - only other inputs are converted
+    if (not np.issubdtype(src_labels.dtype, np.integer) or src_labels.dtype == np.uint64
+            or src_labels.min(initial=0) < 0):
+        src_labels = np.rint(np.clip(src_labels, 0, None)).astype(np.int32)
+
+    # Single pass over the volume: bounding box of every positive label value
+    bboxes = find_objects(src_labels)
+    labels = np.array([k + 1 for k, bb in enumerate(bboxes) if bb is not None], dtype=int)
+    bboxes = [bb for bb in bboxes if bb is not None]
+
+    if args.format == 'separate':
+
+        out_dtype = np.int64 if args.int64 else np.uint8
+
+        jobs = []
+        for label, label_bb in zip(labels, bboxes):
+            out_file = out_stub + '_' + '{0:04d}'.format(int(label)) + '.nii.gz'
+            bb = label_bb if args.crop else (slice(None),) * 3
+            jobs.append((src_labels, label, bb, in_nii.affine, out_dtype, out_file))
+
+        # Masks are extracted and written in the writer threads
+        with ThreadPool(max(1, args.jobs)) as pool:
+            pool.starmap(save_mask, jobs)
+
+    else:
+
+        # Label masks are produced one at a time within their bounding boxes
+        n = labels.size
+
+        if args.format == 'onehot':
+
+            onehot = np.zeros(src_labels.shape + (n,), dtype=np.uint8)
+            for j, (label, bb) in enumerate(zip(labels, bboxes)):
+                onehot[bb + (j,)] = src_labels[bb] == label
+
+            out_file = out_stub + '_onehot.nii.gz'
+            print('Saving %d labels to %s' % (n, out_file))
+            nib.Nifti1Image(onehot, in_nii.affine).to_filename(out_file)
+
+        else:
+
+            # Same layout as np.packbits(onehot, axis=-1), built bit by bit
+            bits = np.zeros(src_labels.shape + ((n + 7) // 8,), dtype=np.uint8)
+            for j, (label, bb) in enumerate(zip(labels, bboxes)):
+                bits[bb + (j // 8,)] |= (src_labels[bb] == label).view(np.uint8) << np.uint8(7 - j % 8)
+
+            out_file = out_stub + '_packed.npz'
+            print('Saving %d packed labels to %s' % (n, out_file))
+            np.savez_compressed(out_file,
+                                bits=bits,
+                                labels=labels,
+                                shape=np.array(src_labels.shape),
+                                affine=in_nii.affine)
+
+        # Label values of the 4D volumes
+        key_file = out_stub + '_labels.txt'
+        np.savetxt(key_file, labels, fmt='%d')
     
     print('Done')
     
@@ -96,6 +148,53 @@ def main():
     sys.exit(0)
 
 
+def save_mask(src_labels, label, bb, affine, out_dtype, out_file):
+    """
+    Extract one label mask within a bounding box and save it
+
+    Parameters
+    ----------
+    src_labels: 3D numpy int array
+        label volume
+    label: int
+        label value of mask
+    bb: tuple of slices
+        mask bounding box (full volume if no cropping)
+    affine: 4 x 4 numpy array
+        source voxel to world transform
+    out_dtype: numpy dtype
+    out_file: string
+        output mask filename
+    """
+
+    # Create mask for current label value
+    out_mask = (src_labels[bb] == label).astype(out_dtype)
+
+    # Shift origin to the first voxel of the bounding box
+    corner = [b.start or 0 for b in bb]
+    out_affine = affine.copy()
+    out_affine[:3, 3] = affine.dot(corner + [1])[:3]
+
+    # Save label mask image
+    print('Saving label %d to %s' % (label, out_file))
+    out_hdr = nib.Nifti1Header()
+    out_hdr.set_data_dtype(out_dtype)
+    out_nii = nib.Nifti1Image(out_mask, out_affine, out_hdr)
+    out_nii.to_filename(out_file)
+
+
+def nifti_stub(fname):
+    """
+    Filename without .nii or .nii.gz extension
+    """
+
+    for ext in ('.gz', '.nii'):
+        if fname.endswith(ext):
+            fname = fname[:-len(ext)]
+
+    return fname
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
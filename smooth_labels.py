@@ -4,12 +4,13 @@ Smooth one or more labels within an integer atlas volume
 
 Usage
 ----
-smooth_labels.py -i <input label image> -o <output label image> [label numbers]
+smooth_labels.py -i <input label image> -o <output label image> [-s <sigma>] [-j <n jobs>] [label numbers]
 smooth_labels.py -h
 
 Example
 ----
 >>> smooth_labels.py -i atlas.nii.gz -o atlas_smooth_5.nii.gz 5 10 11
+>>> smooth_labels.py -i atlas.nii.gz -o atlas_smooth.nii.gz -j 8
 
 Authors
 ----
@@ -19,6 +20,7 @@ Dates
 ----
 2015-04-07 JMT From scratch
 2015-12-08 JMT Update command line arguments and port to python 3
+2026-10-18 Smooth within padded bounding boxes in parallel, resolve overlaps by argmax
 
 License
 ----
@@ -46,8 +48,10 @@ __version__ = '0.1.0'
 
 import sys
 import argparse
-from scipy.ndimage.filters import gaussian_filter
+import multiprocessing as mp
+from scipy.ndimage import gaussian_filter, find_objects
 import nibabel as nib
+import numpy as np
 
 
 def main():
@@ -56,50 +60,67 @@ def main():
     parser = argparse.ArgumentParser(description='Smooth one or more atlas labels')
     parser.add_argument('-i','--in_file', help="source atlas labels filename")
     parser.add_argument('-o','--out_file', help="smoothed atlas labels filename")
-    parser.add_argument('labels', metavar='label', type=int, nargs='+',
-                        help='label numbers to smooth')
+    parser.add_argument('-s','--sigma', type=float, default=1.0, help="Gaussian sigma in voxels [1.0]")
+    parser.add_argument('-j','--jobs', type=int, default=1, help="Number of labels smoothed in parallel [1]")
+    parser.add_argument('labels', metavar='label', type=int, nargs='*',
+                        help='label numbers to smooth [all]')
 
     args = parser.parse_args()
 
     in_file = args.in_file
     out_file = args.out_file
-    labels = args.labels
+    sigma = args.sigma
         
     # Load the source atlas image
     print('Opening %s' % in_file)
     in_nii = nib.load(in_file)
     
-    # Load label image
+    # Load label image, keeping integer on-disk type
     print('Loading labels')
-    src_labels = in_nii.get_data()
-    
-    # Duplicate into output image
+    src_labels = np.asanyarray(in_nii.dataobj)
+    if not np.issubdtype(src_labels.dtype, np.integer):
+        src_labels = np.rint(src_labels).astype(np.int32)
+
+    # Default to all labels present
+    if args.labels:
+        labels = args.labels
+    else:
+        labels = [int(l) for l in np.unique(src_labels) if l > 0]
+
+    # Padded bounding box of each label - wide enough to hold the whole smoothing kernel
+    pad = int(4.0 * sigma + 0.5) + 1
+    bboxes = find_objects(src_labels.clip(0))
+
+    jobs = []
+    for label in labels:
+        if label < 1 or label > len(bboxes) or bboxes[label - 1] is None:
+            print('  Label %d not found - skipping' % label)
+            continue
+        bb = tuple(slice(max(b.start - pad, 0), min(b.stop + pad, n))
+                   for b, n in zip(bboxes[label - 1], src_labels.shape))
+        jobs.append((label, bb, src_labels[bb] == label, sigma))
+
+    print('Smoothing %d labels' % len(jobs))
+    if args.jobs > 1:
+        with mp.Pool(args.jobs) as pool:
+            smoothed = pool.starmap(smooth_label, jobs)
+    else:
+        smoothed = [smooth_label(*job) for job in jobs]
+
+    # Duplicate into output image, clearing the original smoothed labels
     print('Creating new label image')
     out_labels = src_labels.copy()
-    
-    for label in labels:
-        
-        print('  Smoothing label %d' % label)
-    
-        # Extract target label as a boolean mask
-        print('  Identifying target label region %d' % label)
-        label_mask = (src_labels == label)
-    
-        # Smooth target label region
-        print('  Gaussian smoothing original target label')
-        label_mask_smooth = gaussian_filter(label_mask.astype(float), sigma=1.0)
-    
-        # Normalize smoothed intensities
-        label_mask_smooth = label_mask_smooth / label_mask_smooth.max()
-    
-        # Threshold smoothed mask at 0.5 to create new boolean mask
-        print('  Thresholding smoothed label')
-        label_mask_smooth = label_mask_smooth > 0.5
-    
-        # Replace unsmoothed with smoothed label, overwriting other labels
-        print('  Inserting smoothed target label')
-        out_labels[label_mask] = 0
-        out_labels[label_mask_smooth] = label
+    out_labels[np.isin(src_labels, [job[0] for job in jobs])] = 0
+
+    # Per-voxel argmax of smoothed label probability over suprathreshold labels
+    # Ties go to the lower label number, so the result does not depend on label order
+    print('Resolving overlaps between smoothed labels')
+    p_max = np.zeros(src_labels.shape, dtype=np.float32)
+    for label, bb, p in smoothed:
+        out_block, p_block = out_labels[bb], p_max[bb]
+        win = (p > 0.5) & ((p > p_block) | ((p == p_block) & (label < out_block)))
+        out_block[win] = label
+        p_block[win] = p[win]
     
     # Save smoothed labels image
     print('Saving smoothed labels to %s' % out_file)
@@ -112,6 +133,38 @@ def main():
     sys.exit(0)
 
 
+def smooth_label(label, bb, label_mask, sigma):
+    """
+    Gaussian smooth a label mask within its padded bounding box
+
+    Parameters
+    ----------
+    label: int
+    bb: tuple of slices
+        padded bounding box of label mask within the full volume
+    label_mask: 3D numpy bool array
+        label mask within bounding box
+    sigma: float
+        Gaussian sigma in voxels
+
+    Returns
+    -------
+    label: int
+    bb: tuple of slices
+    p: 3D numpy float32 array
+        smoothed label probability normalized to unit maximum
+    """
+
+    print('  Smoothing label %d' % label)
+
+    p = gaussian_filter(label_mask.astype(np.float32), sigma=sigma)
+
+    # Normalize smoothed intensities
+    p /= p.max()
+
+    return label, bb, p
+
+
 # This is the standard boilerplate that calls the main() function.
 if __name__ == '__main__':
     main()
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Label volumes in microliters for many deterministic or probabilistic atlas images
+- deterministic 3D label images: all label voxel counts from one np.bincount
+- probabilistic 4D images: all label integrals from one vectorized reduction
+- files are processed in parallel and tabulated in a single tidy CSV
+  (one row per file and label)
+
+Usage
+----
+volumetrics.py [-m {auto,label,prob}] [-o <output CSV>] [-j <n jobs>] <image> [<image> ...]
+volumetrics.py -h
+
+Example
+----
+>>> volumetrics.py -o volumes.csv atlas.nii.gz *_probs.nii.gz
+
+Authors
+----
+Mike Tyszka, Caltech Brain Imaging Center
+
+Dates
+----
+2026-10-18 Merge label_volumes.py and prob_label_volumes.py logic
+
+License
+----
+This file is part of atlaskit.
+
+    atlaskit is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    atlaskit is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with atlaskit.  If not, see <http://www.gnu.org/licenses/>.
+
+Copyright
+----
+2026 California Institute of Technology.
+"""
+
+__version__ = '0.1.0'
+
+import sys
+import csv
+import argparse
+import multiprocessing as mp
+import nibabel as nib
+import numpy as np
+
+
+def main():
+
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Atlas label volumes in microliters')
+    parser.add_argument('images', type=str, nargs='+', help="3D label or 4D prob label images")
+    parser.add_argument('-m', '--mode', choices=['auto', 'label', 'prob'], default='auto',
+                        help="Image type: deterministic labels, prob labels or detect per file [auto]")
+    parser.add_argument('-o', '--csv', required=False, help="Output CSV filename [stdout]")
+    parser.add_argument('-j', '--jobs', type=int, default=1, help="Number of files processed in parallel [1]")
+
+    # Parse command line arguments
+    args = parser.parse_args()
+
+    jobs = [(fname, args.mode) for fname in args.images]
+
+    if args.jobs > 1 and len(jobs) > 1:
+        with mp.Pool(args.jobs) as pool:
+            volumes = pool.starmap(file_volumes, jobs)
+    else:
+        volumes = [file_volumes(*job) for job in jobs]
+
+    # Tidy table - one row per file and label
+    if args.csv:
+        with open(args.csv, 'w', newline='') as csv_file:
+            write_csv(csv_file, volumes)
+    else:
+        write_csv(sys.stdout, volumes)
+
+    # Clean exit
+    sys.exit(0)
+
+
+def file_volumes(fname, mode='auto'):
+    """
+    Label volumes of one deterministic or probabilistic label image
+
+    Parameters
+    ----------
+    fname: string
+        3D label or 4D prob label image filename
+    mode: string
+        'label', 'prob' or 'auto' (4D or non-integer images are probabilistic)
+
+    Returns
+    -------
+    fname: string
+    labels: numpy int array
+        label numbers (1-based volume index for prob images)
+    vol_vox: numpy array
+        label volumes in voxels (integrated probability for prob images)
+    vol_ul: numpy array
+        label volumes in microliters
+    """
+
+    nii = nib.load(fname)
+    img = np.asanyarray(nii.dataobj)
+
+    # Voxel volume in mm^3 (microliters)
+    vox_ul = np.array(nii.header.get_zooms()[:3]).prod()
+
+    if mode == 'auto':
+        if img.ndim > 3 or not integral(img):
+            mode = 'prob'
+        else:
+            mode = 'label'
+
+    if mode == 'label':
+        labels, vol_vox = label_counts(img)
+    else:
+        labels, vol_vox = prob_sums(img)
+
+    return fname, labels, vol_vox, vol_vox * vox_ul
+
+
+def integral(img):
+    """
+    True if image holds integer label values
+    """
+
+    if np.issubdtype(img.dtype, np.integer):
+        return True
+
+    return bool(np.all(img == np.rint(img)))
+
+
+def label_counts(img):
+    """
+    Voxel counts of all non-empty positive labels from a single np.bincount
+
+    Parameters
+    ----------
+    img: 3D numpy array of integer labels
+
+    Returns
+    -------
+    labels: numpy int array
+    counts: numpy int array
+    """
+
+    img = np.asarray(img)
+    if not np.issubdtype(img.dtype, np.integer):
+        img = np.rint(img).astype(np.int64)
+
+    # Negative labels are ignored (bincount needs non-negative values)
+    if img.min(initial=0) < 0:
+        counts = np.bincount(img[img > 0])
+    else:
+        counts = np.bincount(img.ravel())
+
+    labels = np.flatnonzero(counts)
+    labels = labels[labels > 0]
+
+    return labels, counts[labels]
+
+
+def prob_sums(img):
+    """
+    Integrated probability of every label volume in one reduction
+
+    Parameters
+    ----------
+    img: 3D or 4D numpy array of prob labels
+
+    Returns
+    -------
+    labels: numpy int array
+        1-based label volume index
+    sums: numpy float array
+    """
+
+    img = np.asarray(img)
+    nt = img.shape[3] if img.ndim > 3 else 1
+
+    # Treat probabilities as partial volumes and integrate (no reshape copy of strided volumes)
+    sums = np.atleast_1d(img.sum(axis=(0, 1, 2), dtype=np.float64))
+
+    return np.arange(1, nt + 1), sums
+
+
+def write_csv(csv_file, volumes):
+    """
+    Write tidy volume table with one row per file and label
+
+    Parameters
+    ----------
+    csv_file: open text file
+    volumes: list of file_volumes() results
+    """
+
+    writer = csv.writer(csv_file)
+    writer.writerow(['File', 'Label', 'Voxels', 'Volume_ul'])
+
+    for fname, labels, vol_vox, vol_ul in volumes:
+        for label, v_vox, v_ul in zip(labels, vol_vox, vol_ul):
+            writer.writerow([fname, int(label), v_vox, '%0.3f' % v_ul])
+
+
+# This is the standard boilerplate that calls the main() function.
+if __name__ == '__main__':
+    main()